@@ -0,0 +1,34 @@
+import unittest
+
+from uwebp import WebPIDecoder, WebPReader
+
+
+def load(name):
+    path = __file__.rsplit("/", 1)[0] + "/" + name if "/" in __file__ else name
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class TestWebPIDecoder(unittest.TestCase):
+    def test_partitions_fed_in_small_chunks(self):
+        # 4 token partitions, each set up only once enough of it has arrived
+        data = load("partitions.webp")
+        expected = WebPReader(data).read()
+
+        for start in range(1, 8):
+            decoder = WebPIDecoder()
+            rows = []
+            i = 0
+            n = start
+            while i < len(data):
+                decoder.feed(data[i : i + n])
+                rows += decoder.read_rows()
+                i += n
+                n = n % 7 + 1
+
+            self.assertTrue(decoder.is_done())
+            self.assertEqual(rows, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1 +1,2 @@
-from .webpimage import WebPReader
+from .webpimage import WebPReader, WebPInfo, PixelFormat, probe
+from .idecoder import WebPIDecoder
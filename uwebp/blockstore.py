@@ -0,0 +1,55 @@
+from array import array
+
+
+def zeros(typecode, n):
+    # array(typecode, bytes(size)) copies raw bytes on MicroPython but takes
+    # one element per byte on CPython, so grow the array from a small block
+    a = array(typecode)
+    block = array(typecode, [0] * min(n, 1024))
+    while n >= len(block) > 0:
+        a.extend(block)
+        n -= len(block)
+    a.extend(array(typecode, [0] * n))
+    return a
+
+
+class BlockStore:
+    # Structure-of-arrays storage behind the MacroBlock and SubBlock views.
+    #
+    # Per macroblock, for every row of the frame or only the last two rows
+    # of a low-memory frame: modes, skip flag, segment and whether it had
+    # any coefficients. Macroblock (x, y) is at index (y % rows) * cols + x.
+    #
+    # Per block, for the last block_rows rows parsed: the 16 coefficients
+    # in raster order, the nonzero count and a bitmask of nonzero positions.
+    # The blocks of a macroblock are numbered from block(x, y): Y in raster
+    # order, then U, V and Y2. One row is enough when every row is
+    # reconstructed right after it is parsed.
+    BLOCKS = 25
+    U = 16
+    V = 20
+    Y2 = 24
+
+    def __init__(self, cols, rows, block_rows=1):
+        n = cols * rows
+        self.cols = cols
+        self.rows = rows
+        self.blockRows = block_rows
+        self.yModes = bytearray(n)
+        self.uvModes = bytearray(n)
+        self.skip = bytearray(n)
+        self.segments = bytearray(n)
+        self.nonZero = bytearray(n)
+        # subblock modes of B_PRED macroblocks, 16 each in raster order
+        self.bModes = bytearray(16 * n)
+
+        blocks = cols * block_rows * self.BLOCKS
+        self.coeffs = zeros("h", 16 * blocks)
+        self.nz = bytearray(blocks)
+        self.nzMasks = zeros("H", blocks)
+
+    def index(self, mb_col, mb_row):
+        return (mb_row % self.rows) * self.cols + mb_col
+
+    def block(self, mb_col, mb_row):
+        return ((mb_row % self.blockRows) * self.cols + mb_col) * self.BLOCKS
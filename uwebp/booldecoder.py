@@ -1,11 +1,21 @@
 import micropython
+import sys
 from .globals import VP8DX_BITREADER_NORM
 
 
+# Bytes loaded per refill. The value window holds these plus the 8 bit
+# decoding window, kept within a small int on both 32 and 64-bit ports.
+WINDOW_BYTES = 6 if sys.maxsize > 1 << 32 else 2
+
+
 class BoolDecoder:
-    def __init__(self, frame, offset):
+    def __init__(self, frame, offset, end=-1):
         self.data = frame
         self.offset = offset
+        # The partition end, or as much of it as is buffered. Bytes past it
+        # are read as zeros, with offset still counting them, so offset >
+        # end once a read went past it.
+        self.end = len(frame) if end < 0 else end
         self.init_bool_decoder()
 
     def __str__(self):
@@ -13,49 +23,105 @@ class BoolDecoder:
 
     def init_bool_decoder(self):
         self.value = 0
-        self.value = self.data[self.offset] << 8
-        self.offset += 1
+        # number of bits buffered below the 8 bit decoding window
+        self.bits = -8
         self.range = 255
-        self.bit_count = 0
-    
+        self.load_new_bytes()
+
+    def get_state(self):
+        return (self.offset, self.value, self.range, self.bits)
+
+    def set_state(self, state):
+        self.offset, self.value, self.range, self.bits = state
+
     @micropython.native
-    def read_bool(self, probability):
-        bit = 0
-        _range = self.range
+    def load_new_bytes(self):
+        data = self.data
+        offset = self.offset
         value = self.value
-        split = 1 + ((_range - 1) * probability >> 8)
-        bigsplit = split << 8
-        _range = split
-        if value >= bigsplit:
+        bits = self.bits
+
+        if offset + WINDOW_BYTES <= self.end:
+            for i in range(WINDOW_BYTES):
+                value = (value << 8) | data[offset + i]
+            offset += WINDOW_BYTES
+            bits += WINDOW_BYTES * 8
+        else:
+            while bits < 0:
+                if offset < self.end:
+                    value = (value << 8) | data[offset]
+                else:
+                    value <<= 8
+                offset += 1
+                bits += 8
+
+        self.offset = offset
+        self.value = value
+        self.bits = bits
+
+    @micropython.native
+    def read_bool(self, probability):
+        if self.bits < 0:
+            self.load_new_bytes()
+
+        bits = self.bits
+        split = 1 + (((self.range - 1) * probability) >> 8)
+        bigsplit = split << bits
+        if self.value >= bigsplit:
             _range = self.range - split
-            value -= bigsplit
+            self.value -= bigsplit
             bit = 1
+        else:
+            _range = split
+            bit = 0
 
-        count = self.bit_count
         shift = VP8DX_BITREADER_NORM[_range]
-        _range <<= shift
-        value <<= shift
-        count -= shift
-        if count <= 0:
-            value |= self.data[self.offset] << -count
-            self.offset += 1
-            count += 8
-
-        self.bit_count = count
-        self.value = value
-        self.range = _range
+        self.range = _range << shift
+        self.bits = bits - shift
         return bit
-    
+
     @micropython.native
     def read_literal(self, num_bits):
+        # read_bool(128) for each bit, with the state kept in locals
         v = 0
+        value = self.value
+        _range = self.range
+        bits = self.bits
         for _ in range(num_bits):
-            v = (v << 1) + self.read_bool(128)
+            if bits < 0:
+                self.value = value
+                self.bits = bits
+                self.load_new_bytes()
+                value = self.value
+                bits = self.bits
+
+            split = (_range + 1) >> 1
+            bigsplit = split << bits
+            if value >= bigsplit:
+                _range -= split
+                value -= bigsplit
+                v = (v << 1) | 1
+            else:
+                _range = split
+                v <<= 1
+
+            shift = VP8DX_BITREADER_NORM[_range]
+            _range <<= shift
+            bits -= shift
+
+        self.value = value
+        self.range = _range
+        self.bits = bits
         return v
 
+    def read_signed(self, num_bits):
+        # magnitude followed by a sign bit
+        v = self.read_literal(num_bits + 1)
+        return -(v >> 1) if v & 1 else v >> 1
+
     def read_bit(self):
-        return self.read_bool(128)
-    
+        return self.read_literal(1)
+
     @micropython.native
     def treed_read(self, t, p, skip_branches=0):
         i = skip_branches * 2
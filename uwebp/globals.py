@@ -551,7 +551,20 @@ P_CAT_3 = const((173, 148, 140, 0))
 P_CAT_4 = const((176, 155, 140, 135, 0))
 P_CAT_5 = const((180, 157, 141, 134, 130, 0))
 P_CAT_6 = const((254, 254, 243, 230, 196, 177, 153, 140, 133, 130, 129, 0))
+# extra-bit probabilities of DCT_CAT3..DCT_CAT6, zero terminated
+DCT_CAT_PROBS = const((P_CAT_3, P_CAT_4, P_CAT_5, P_CAT_6))
 COEF_BANDS = const((0, 1, 2, 3, 6, 4, 5, 6, 6, 6, 6, 6, 6, 6, 6, 7))
+
+# The coefficient probability tables flattened to [type][band][context][token]
+# byte arrays, 4 * 8 * 3 * 11 entries; a frame's tables are reset from these
+# with one slice copy.
+COEF_PROBS_SIZE = const(1056)
+DEFAULT_COEF_PROBS_FLAT = bytes(
+    p for t in DEFAULT_COEF_PROBS for b in t for c in b for p in c
+)
+COEF_UPDATE_PROBS_FLAT = bytes(
+    p for t in COEF_UPDATE_PROBS for b in t for c in b for p in c
+)
 DEFAULT_ZIG_ZAG_1D = const((0, 1, 4, 8, 5, 2, 3, 6, 9, 12, 13, 10, 7, 11, 14, 15))
 VP8DX_BITREADER_NORM = const((
     0,
@@ -2,14 +2,21 @@ import micropython
 
 
 class IDCT:
+    # All transforms return the 16 residuals of a 4x4 block as one flat
+    # list in raster order, i.e. the value of column x, row y is at
+    # y * 4 + x.
     cospi8sqrt2minus1 = 20091
     sinpi8sqrt2 = 35468
 
+    # bitmasks over raster positions, used to pick a transform for a block
+    # from the positions of its nonzero coefficients
+    ROW_MASK = 0x000F
+    COLUMN_MASK = 0x1111
+
     @staticmethod
     @micropython.native
     def iwalsh4x4(input_array):
         output = [0] * 16
-        diff = [[0] * 4 for _ in range(4)]
         offset = 0
 
         for i in range(4):
@@ -38,13 +45,14 @@ class IDCT:
             output[offset + 1] = (b2 + 3) >> 3
             output[offset + 2] = (c2 + 3) >> 3
             output[offset + 3] = (d2 + 3) >> 3
-            diff[0][i] = (a2 + 3) >> 3
-            diff[1][i] = (b2 + 3) >> 3
-            diff[2][i] = (c2 + 3) >> 3
-            diff[3][i] = (d2 + 3) >> 3
             offset += 4
 
-        return diff
+        return output
+
+    @staticmethod
+    def iwalsh4x4_dc(dc):
+        # only the DC input is set: every output is the same
+        return [(dc + 3) >> 3] * 16
 
     @staticmethod
     @micropython.native
@@ -71,32 +79,66 @@ class IDCT:
             output[offset + 8] = b1 - c1
             offset += 1
 
-        diffo = 0
-        diff = [[0] * 4 for _ in range(4)]
         offset = 0
 
         for _ in range(4):
-            a1 = output[offset * 4 + 0] + output[offset * 4 + 2]
-            b1 = output[offset * 4 + 0] - output[offset * 4 + 2]
-            temp1 = output[offset * 4 + 1] * IDCT.sinpi8sqrt2 >> 16
-            temp2 = output[offset * 4 + 3] + (
-                output[offset * 4 + 3] * IDCT.cospi8sqrt2minus1 >> 16
+            a1 = output[offset + 0] + output[offset + 2]
+            b1 = output[offset + 0] - output[offset + 2]
+            temp1 = output[offset + 1] * IDCT.sinpi8sqrt2 >> 16
+            temp2 = output[offset + 3] + (
+                output[offset + 3] * IDCT.cospi8sqrt2minus1 >> 16
             )
             c1 = temp1 - temp2
-            temp1 = output[offset * 4 + 1] + (
-                output[offset * 4 + 1] * IDCT.cospi8sqrt2minus1 >> 16
+            temp1 = output[offset + 1] + (
+                output[offset + 1] * IDCT.cospi8sqrt2minus1 >> 16
             )
-            temp2 = output[offset * 4 + 3] * IDCT.sinpi8sqrt2 >> 16
+            temp2 = output[offset + 3] * IDCT.sinpi8sqrt2 >> 16
             d1 = temp1 + temp2
-            output[offset * 4 + 0] = (a1 + d1 + 4) >> 3
-            output[offset * 4 + 3] = (a1 - d1 + 4) >> 3
-            output[offset * 4 + 1] = (b1 + c1 + 4) >> 3
-            output[offset * 4 + 2] = (b1 - c1 + 4) >> 3
-            diff[0][diffo] = (a1 + d1 + 4) >> 3
-            diff[3][diffo] = (a1 - d1 + 4) >> 3
-            diff[1][diffo] = (b1 + c1 + 4) >> 3
-            diff[2][diffo] = (b1 - c1 + 4) >> 3
-            offset += 1
-            diffo += 1
+            output[offset + 0] = (a1 + d1 + 4) >> 3
+            output[offset + 3] = (a1 - d1 + 4) >> 3
+            output[offset + 1] = (b1 + c1 + 4) >> 3
+            output[offset + 2] = (b1 - c1 + 4) >> 3
+            offset += 4
+
+        return output
 
-        return diff
+    @staticmethod
+    @micropython.native
+    def idct4x4_row(input_array):
+        # Only the first row of coefficients is set. The vertical pass then
+        # copies each of them down its column, so every output row is the
+        # horizontal transform of that first row.
+        a1 = input_array[0] + input_array[2]
+        b1 = input_array[0] - input_array[2]
+        temp1 = input_array[1] * IDCT.sinpi8sqrt2 >> 16
+        temp2 = input_array[3] + (input_array[3] * IDCT.cospi8sqrt2minus1 >> 16)
+        c1 = temp1 - temp2
+        temp1 = input_array[1] + (input_array[1] * IDCT.cospi8sqrt2minus1 >> 16)
+        temp2 = input_array[3] * IDCT.sinpi8sqrt2 >> 16
+        d1 = temp1 + temp2
+        return [
+            (a1 + d1 + 4) >> 3,
+            (b1 + c1 + 4) >> 3,
+            (b1 - c1 + 4) >> 3,
+            (a1 - d1 + 4) >> 3,
+        ] * 4
+
+    @staticmethod
+    @micropython.native
+    def idct4x4_column(input_array):
+        # Only the first column of coefficients is set. After the vertical
+        # pass the other columns are zero, so each output row is constant.
+        a1 = input_array[0] + input_array[8]
+        b1 = input_array[0] - input_array[8]
+        temp1 = input_array[4] * IDCT.sinpi8sqrt2 >> 16
+        temp2 = input_array[12] + (input_array[12] * IDCT.cospi8sqrt2minus1 >> 16)
+        c1 = temp1 - temp2
+        temp1 = input_array[4] + (input_array[4] * IDCT.cospi8sqrt2minus1 >> 16)
+        temp2 = input_array[12] * IDCT.sinpi8sqrt2 >> 16
+        d1 = temp1 + temp2
+        return (
+            [(a1 + d1 + 4) >> 3] * 4
+            + [(b1 + c1 + 4) >> 3] * 4
+            + [(b1 - c1 + 4) >> 3] * 4
+            + [(a1 - d1 + 4) >> 3] * 4
+        )
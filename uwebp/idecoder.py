@@ -0,0 +1,196 @@
+from .vp8decoder import VP8Decoder
+from .webpimage import (
+    RIFFReader,
+    WebPImageType,
+    WebPInfo,
+    _head_size,
+    _probe_chunk,
+    band_to_rgb,
+)
+
+
+class WebPIDecoder:
+    def __init__(self, loop_filter=True):
+        self.decoder = VP8Decoder(loop_filter)
+        self.header = bytearray()
+        # absolute offset of the bytes in header, payload bytes still to be
+        # skipped and the end of the RIFF data, once its header is read
+        self.offset = 0
+        self.skip = 0
+        self.end = -1
+        self.data = None
+        self.info = None
+        self.frame = None
+        self.frame_size = 0
+        self.mb_row = 0
+        self.mb_col = 0
+        self.mb_rows_read = 0
+
+    def get_width(self):
+        return self.info.width if self.info else 0
+
+    def get_height(self):
+        return self.info.height if self.info else 0
+
+    def get_frame(self):
+        return self.frame
+
+    def feed(self, chunk):
+        if self.data is None:
+            if not self._parse_header(memoryview(chunk)):
+                return 0
+        else:
+            self.data.extend(chunk[: self.frame_size - len(self.data)])
+
+        if self.frame is None and not self._parse_frame_header():
+            return 0
+
+        self._decode_rows()
+        return self.rows_available()
+
+    def rows_available(self):
+        if self.frame is None:
+            return 0
+        rows = self.frame.get_finished_rows(self.mb_row)
+        return min(rows * 16, self.frame.get_height())
+
+    def is_done(self):
+        return (
+            self.frame is not None
+            and self.mb_row == self.frame.get_macro_block_rows()
+        )
+
+    def read_rows(self):
+        if self.frame is None:
+            return []
+
+        first = self.mb_rows_read
+        last = self.frame.get_finished_rows(self.mb_row)
+        if first == last:
+            return []
+
+        rows = band_to_rgb(self.frame, first, last)
+        self.mb_rows_read = last
+        return rows
+
+    def _parse_header(self, chunk):
+        # Walks the chunks as their bytes arrive, carrying on from the last
+        # one parsed. Only the chunk header being parsed is buffered; the
+        # payloads ahead of the VP8 frame are dropped as they come in.
+        header = self.header
+        while True:
+            if self.skip:
+                n = min(self.skip, len(chunk))
+                self.skip -= n
+                self.offset += n
+                chunk = chunk[n:]
+                if self.skip:
+                    return False
+
+            if self.end < 0:
+                need = 12
+            else:
+                if not header and self.offset + 8 > self.end:
+                    raise ValueError("Bad VP8 signature!")
+                need = 8
+                if len(header) >= 8:
+                    need += _head_size(bytes(header[:4]))
+            n = need - len(header)
+            header.extend(chunk[:n])
+            chunk = chunk[n:]
+            if len(header) < need:
+                return False
+
+            if self.end < 0:
+                riff = RIFFReader(bytes(header))
+                riff.read_header()
+                self.end = riff.end
+                self.info = WebPInfo()
+            elif need == 8 and _head_size(bytes(header[:4])):
+                # the payload bytes probed come next
+                continue
+            else:
+                fourcc = bytes(header[:4])
+                size = int.from_bytes(header[4:8], "little")
+                self.info.chunks.append((fourcc, self.offset + 8, size))
+                if _probe_chunk(self.info, fourcc, self.offset + 8, size, header[8:]):
+                    if fourcc != WebPImageType.VP8_:
+                        raise ValueError("Bad VP8 signature!")
+                    self.frame_size = size
+                    self.data = bytearray(header[8:])
+                    self.data.extend(chunk[: size - len(self.data)])
+                    self.header = None
+                    return True
+                # payloads are padded to an even size
+                self.skip = size + (size & 1) - (need - 8)
+
+            self.offset += need
+            self.header = header = bytearray()
+
+    def _parse_frame_header(self):
+        data = self.data
+        first_partition_length = (data[0] | (data[1] << 8) | (data[2] << 16)) >> 5
+        # frame tag, first partition and up to 7 partition sizes
+        if len(data) < min(self.frame_size, 10 + first_partition_length + 21):
+            return False
+
+        self.frame = self.decoder.decode_frame_header(
+            data, frame_size=self.frame_size
+        )
+        return True
+
+    def _decode_rows(self):
+        frame = self.frame
+        num_part = len(frame.tokenBoolDecoders)
+        available = len(self.data)
+
+        # token partitions are read up to the bytes buffered so far
+        for i in range(num_part):
+            bc = frame.tokenBoolDecoders[i]
+            if bc is None and frame.token_partition_ready(i, available):
+                frame.init_token_partition(i)
+                bc = frame.tokenBoolDecoders[i]
+            if bc is not None:
+                bc.end = min(frame.partitionEnds[i], available)
+
+        while self.mb_row < frame.get_macro_block_rows():
+            i = self.mb_row & (num_part - 1)
+            bc = frame.tokenBoolDecoders[i]
+            if bc is None or not self._parse_row(bc, frame.partitionEnds[i]):
+                return
+
+            frame.reconstruct_macro_block_row(self.mb_row)
+            self.mb_row += 1
+
+    def _parse_row(self, bc, end):
+        # Parses the rest of the current row. Before a partition is complete
+        # every macroblock is checkpointed: one that reads past the bytes
+        # buffered is rolled back and parsed again once more have arrived.
+        frame = self.frame
+        n = frame.NZ_CONTEXTS
+        above = frame.aboveNz
+        left = frame.leftNz
+        partial = bc.end < end
+        if self.mb_col == 0:
+            for i in range(n):
+                left[i] = 0
+
+        for mb_col in range(self.mb_col, frame.get_macro_block_cols()):
+            if partial:
+                a = mb_col * n
+                state = bc.get_state()
+                contexts = bytes(above[a : a + n]) + bytes(left)
+
+            frame.get_macro_block(mb_col, self.mb_row).decode_macro_block(
+                frame, bc, left
+            )
+
+            if partial and bc.offset > bc.end:
+                bc.set_state(state)
+                above[a : a + n] = contexts[:n]
+                left[:] = contexts[n:]
+                self.mb_col = mb_col
+                return False
+
+        self.mb_col = 0
+        return True
@@ -0,0 +1,257 @@
+import micropython
+
+
+class LoopFilter:
+    MAX_LEVEL = 63
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.simple = frame.get_filter_type() == 1
+        sharpness = frame.get_sharpness_level()
+
+        # limits only depend on the filter level once sharpness is known
+        self.interior_limit = bytearray(self.MAX_LEVEL + 1)
+        self.hev_threshold = bytearray(self.MAX_LEVEL + 1)
+        self.sub_block_limit = bytearray(self.MAX_LEVEL + 1)
+        self.macro_block_limit = bytearray(self.MAX_LEVEL + 1)
+        for level in range(self.MAX_LEVEL + 1):
+            interior = level
+            if sharpness > 0:
+                interior >>= 2 if sharpness > 4 else 1
+                if interior > 9 - sharpness:
+                    interior = 9 - sharpness
+            if interior < 1:
+                interior = 1
+
+            self.interior_limit[level] = interior
+            self.hev_threshold[level] = 2 if level >= 40 else 1 if level >= 15 else 0
+            self.sub_block_limit[level] = level * 2 + interior
+            self.macro_block_limit[level] = (level + 2) * 2 + interior
+
+        # filter level of 16x16 and B_PRED macroblocks, per segment
+        self.levels = [
+            [self.get_level(segment, False), self.get_level(segment, True)]
+            for segment in range(frame.MAX_MB_SEGMENTS)
+        ]
+
+    def get_level(self, segment, b_pred):
+        frame = self.frame
+        level = frame.get_filter_level()
+        if frame.segmentation_enabled > 0:
+            if frame.mb_segement_abs_delta > 0:
+                level = frame.segmentFilterLevels[segment]
+            else:
+                level += frame.segmentFilterLevels[segment]
+        if frame.modeRefLfDeltaEnabled > 0:
+            level += frame.refLfDeltas[0]
+            if b_pred:
+                level += frame.modeLfDeltas[0]
+        return max(0, min(self.MAX_LEVEL, level))
+
+    @micropython.native
+    def filter_row(self, mb_row):
+        frame = self.frame
+        y_plane = frame.yPlane
+        # chroma planes, none when only luma is decoded
+        chroma = () if frame.lumaOnly else (frame.uPlane, frame.vPlane)
+        y_stride = frame.yStride
+        uv_stride = frame.uvStride
+        # offsets are relative to the rows the planes still hold
+        plane_row = mb_row - frame.planeRow
+
+        store = frame.blocks
+        mb = store.index(0, mb_row)
+        for mb_col in range(frame.get_needed_cols(mb_row)):
+            b_pred = store.yModes[mb] == 4
+            level = self.levels[store.segments[mb]][1 if b_pred else 0]
+            inner = b_pred or store.nonZero[mb]
+            mb += 1
+            if level == 0:
+                continue
+
+            # inner edges are left alone on 16x16 blocks without residual
+            mb_limit = self.macro_block_limit[level]
+            sb_limit = self.sub_block_limit[level]
+            y = plane_row * 16 * y_stride + mb_col * 16
+
+            if self.simple:
+                if mb_col > 0:
+                    LoopFilter.simple_filter(y_plane, y, 1, y_stride, mb_limit)
+                if inner:
+                    for i in (4, 8, 12):
+                        LoopFilter.simple_filter(y_plane, y + i, 1, y_stride, sb_limit)
+                if mb_row > 0:
+                    LoopFilter.simple_filter(y_plane, y, y_stride, 1, mb_limit)
+                if inner:
+                    for i in (4, 8, 12):
+                        LoopFilter.simple_filter(
+                            y_plane, y + i * y_stride, y_stride, 1, sb_limit
+                        )
+                continue
+
+            interior = self.interior_limit[level]
+            hev = self.hev_threshold[level]
+            uv = plane_row * 8 * uv_stride + mb_col * 8
+
+            if mb_col > 0:
+                LoopFilter.normal_filter(
+                    y_plane, y, 1, y_stride, 16, mb_limit, interior, hev, True
+                )
+                for plane in chroma:
+                    LoopFilter.normal_filter(
+                        plane, uv, 1, uv_stride, 8, mb_limit, interior, hev, True
+                    )
+            if inner:
+                for i in (4, 8, 12):
+                    LoopFilter.normal_filter(
+                        y_plane, y + i, 1, y_stride, 16, sb_limit, interior, hev, False
+                    )
+                for plane in chroma:
+                    LoopFilter.normal_filter(
+                        plane, uv + 4, 1, uv_stride, 8, sb_limit, interior, hev, False
+                    )
+            if mb_row > 0:
+                LoopFilter.normal_filter(
+                    y_plane, y, y_stride, 1, 16, mb_limit, interior, hev, True
+                )
+                for plane in chroma:
+                    LoopFilter.normal_filter(
+                        plane, uv, uv_stride, 1, 8, mb_limit, interior, hev, True
+                    )
+            if inner:
+                for i in (4, 8, 12):
+                    LoopFilter.normal_filter(
+                        y_plane,
+                        y + i * y_stride,
+                        y_stride,
+                        1,
+                        16,
+                        sb_limit,
+                        interior,
+                        hev,
+                        False,
+                    )
+                for plane in chroma:
+                    LoopFilter.normal_filter(
+                        plane,
+                        uv + 4 * uv_stride,
+                        uv_stride,
+                        1,
+                        8,
+                        sb_limit,
+                        interior,
+                        hev,
+                        False,
+                    )
+
+    @staticmethod
+    @micropython.native
+    def simple_filter(buf, o, step, pitch, limit):
+        # 16 pixels across an edge; step crosses the edge, pitch runs along it
+        limit = limit * 2 + 1
+        for _ in range(16):
+            p1 = buf[o - 2 * step]
+            p0 = buf[o - step]
+            q0 = buf[o]
+            q1 = buf[o + step]
+            d0 = p0 - q0 if p0 > q0 else q0 - p0
+            d1 = p1 - q1 if p1 > q1 else q1 - p1
+            if d0 * 4 + d1 <= limit:
+                LoopFilter.common_adjust(buf, o, step, p1, p0, q0, q1)
+            o += pitch
+
+    @staticmethod
+    @micropython.native
+    def common_adjust(buf, o, step, p1, p0, q0, q1):
+        a = p1 - q1
+        if a < -128:
+            a = -128
+        elif a > 127:
+            a = 127
+        a += 3 * (q0 - p0)
+        if a < -128:
+            a = -128
+        elif a > 127:
+            a = 127
+
+        f1 = (a + 4 if a < 124 else 127) >> 3
+        f2 = (a + 3 if a < 124 else 127) >> 3
+        p0 += f2
+        q0 -= f1
+        buf[o - step] = 0 if p0 < 0 else 255 if p0 > 255 else p0
+        buf[o] = 0 if q0 < 0 else 255 if q0 > 255 else q0
+
+    @staticmethod
+    @micropython.native
+    def normal_filter(buf, o, step, pitch, size, limit, interior, hev, mb_edge):
+        limit = limit * 2 + 1
+        for _ in range(size):
+            p3 = buf[o - 4 * step]
+            p2 = buf[o - 3 * step]
+            p1 = buf[o - 2 * step]
+            p0 = buf[o - step]
+            q0 = buf[o]
+            q1 = buf[o + step]
+            q2 = buf[o + 2 * step]
+            q3 = buf[o + 3 * step]
+
+            d0 = p0 - q0 if p0 > q0 else q0 - p0
+            d1 = p1 - q1 if p1 > q1 else q1 - p1
+            dp1 = p1 - p0 if p1 > p0 else p0 - p1
+            dq1 = q1 - q0 if q1 > q0 else q0 - q1
+            if (
+                d0 * 4 + d1 <= limit
+                and (p3 - p2 if p3 > p2 else p2 - p3) <= interior
+                and (p2 - p1 if p2 > p1 else p1 - p2) <= interior
+                and dp1 <= interior
+                and (q3 - q2 if q3 > q2 else q2 - q3) <= interior
+                and (q2 - q1 if q2 > q1 else q1 - q2) <= interior
+                and dq1 <= interior
+            ):
+                if dp1 > hev or dq1 > hev:
+                    LoopFilter.common_adjust(buf, o, step, p1, p0, q0, q1)
+                elif mb_edge:
+                    w = p1 - q1
+                    if w < -128:
+                        w = -128
+                    elif w > 127:
+                        w = 127
+                    w += 3 * (q0 - p0)
+                    if w < -128:
+                        w = -128
+                    elif w > 127:
+                        w = 127
+
+                    a = (27 * w + 63) >> 7
+                    v = p0 + a
+                    buf[o - step] = 0 if v < 0 else 255 if v > 255 else v
+                    v = q0 - a
+                    buf[o] = 0 if v < 0 else 255 if v > 255 else v
+                    a = (18 * w + 63) >> 7
+                    v = p1 + a
+                    buf[o - 2 * step] = 0 if v < 0 else 255 if v > 255 else v
+                    v = q1 - a
+                    buf[o + step] = 0 if v < 0 else 255 if v > 255 else v
+                    a = (9 * w + 63) >> 7
+                    v = p2 + a
+                    buf[o - 3 * step] = 0 if v < 0 else 255 if v > 255 else v
+                    v = q2 - a
+                    buf[o + 2 * step] = 0 if v < 0 else 255 if v > 255 else v
+                else:
+                    a = 3 * (q0 - p0)
+                    if a < -128:
+                        a = -128
+                    elif a > 127:
+                        a = 127
+                    f1 = (a + 4 if a < 124 else 127) >> 3
+                    f2 = (a + 3 if a < 124 else 127) >> 3
+                    a = (f1 + 1) >> 1
+                    v = p0 + f2
+                    buf[o - step] = 0 if v < 0 else 255 if v > 255 else v
+                    v = q0 - f1
+                    buf[o] = 0 if v < 0 else 255 if v > 255 else v
+                    v = p1 + a
+                    buf[o - 2 * step] = 0 if v < 0 else 255 if v > 255 else v
+                    v = q1 - a
+                    buf[o + step] = 0 if v < 0 else 255 if v > 255 else v
+            o += pitch
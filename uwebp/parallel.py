@@ -0,0 +1,263 @@
+import time
+from array import array
+
+try:
+    import threading
+except ImportError:
+    threading = None
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    ProcessPoolExecutor = None
+    SharedMemory = None
+
+try:
+    from os import cpu_count
+except ImportError:
+    cpu_count = None
+
+
+# Runs the two passes of a two-pass frame over several workers.
+#
+# Rows are not independent, in either pass. The nonzero contexts of a
+# macroblock come from the one above it, and its prediction from the ones to
+# the left, above and above-right. Workers therefore follow a wavefront: every
+# row publishes how many macroblocks it has finished, and a row starts a
+# macroblock only once the row above is far enough ahead of it, by one
+# macroblock when parsing and two when reconstructing. These per-row counters
+# are the only synchronisation.
+#
+# "thread" runs the workers as threads of this process. They only speed up
+# decoding on a free-threaded CPython or on ports without a global lock.
+# "process" runs them in separate processes, CPython only. Those share the
+# arrays they read and write through multiprocessing.shared_memory, and each
+# rebuilds the frame header and modes from the frame data.
+ENGINES = ("thread", "process")
+
+
+def parse_partitions(frame, engine="thread"):
+    # one worker per token partition: partition p holds the rows p, p + n,
+    # p + 2n, ... of an n-partition frame
+    _run(frame, engine, _parse_arrays, _parse_rows, len(frame.tokenBoolDecoders))
+
+
+def reconstruct_rows(frame, engine="thread"):
+    # Predicts and adds the residual of every macroblock; worker w takes the
+    # rows w, w + n, w + 2n, ... The loop filter is left to the caller.
+    workers = (cpu_count() if cpu_count else 0) or 2
+    _run(
+        frame,
+        engine,
+        _reconstruct_arrays,
+        _reconstruct_rows,
+        min(workers, frame.macroBlockRows),
+    )
+
+
+def _run(frame, engine, arrays, job, workers):
+    if engine not in ENGINES:
+        raise ValueError("Unsupported parallel engine: " + str(engine))
+    if engine == "thread":
+        if threading is None:
+            raise ValueError("Threads are not available")
+        _run_threads(frame, job, workers)
+    else:
+        if SharedMemory is None:
+            raise ValueError("Processes are not available")
+        _run_processes(frame, arrays, job, workers)
+
+
+def _wait(progress, row, needed, abort):
+    # Waits until row has finished needed macroblocks and returns how many it
+    # has, or -1 once another worker has failed.
+    ready = progress[row]
+    while ready < needed:
+        if progress[abort]:
+            return -1
+        time.sleep(0)
+        ready = progress[row]
+    return ready
+
+
+def _parse_rows(frame, first, step, progress):
+    # progress[row] is the number of macroblocks of row already done; the
+    # entry after the last row is set when a worker fails, so that the others
+    # stop waiting for it
+    cols = frame.macroBlockCols
+    rows = frame.macroBlockRows
+    bc = frame.tokenBoolDecoders[first]
+    left = bytearray(frame.NZ_CONTEXTS)
+
+    try:
+        for row in range(first, rows, step):
+            for i in range(frame.NZ_CONTEXTS):
+                left[i] = 0
+
+            ready = cols if row == 0 else 0
+            for col in range(cols):
+                if ready <= col:
+                    ready = _wait(progress, row - 1, col + 1, rows)
+                    if ready < 0:
+                        return
+
+                frame.get_macro_block(col, row).decode_macro_block(frame, bc, left)
+                progress[row] = col + 1
+    except BaseException:
+        progress[rows] = 1
+        raise
+
+
+def _reconstruct_rows(frame, first, step, progress):
+    # The above-right macroblock has to be done as well. A cropped frame only
+    # needs the first rows, and fewer macroblocks of each row than the one
+    # above it.
+    rows = frame.macroBlockRows
+
+    try:
+        for row in range(first, frame.mbRowsNeeded, step):
+            cols = frame.get_needed_cols(row)
+            above = frame.get_needed_cols(row - 1)
+            ready = above if row == 0 else 0
+            for col in range(cols):
+                needed = min(col + 2, above)
+                if ready < needed:
+                    ready = _wait(progress, row - 1, needed, rows)
+                    if ready < 0:
+                        return
+
+                frame.get_macro_block(col, row).dequant_macro_block(frame)
+                progress[row] = col + 1
+    except BaseException:
+        progress[rows] = 1
+        raise
+
+
+def _run_threads(frame, job, workers):
+    progress = array("i", [0] * (frame.macroBlockRows + 1))
+    errors = []
+
+    def run(first):
+        try:
+            job(frame, first, workers, progress)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(w,)) for w in range(1, workers)]
+    for thread in threads:
+        thread.start()
+    run(0)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def _parse_arrays(frame):
+    # (owner, attribute, typecode, length) of everything the workers share
+    store = frame.blocks
+    return (
+        (store, "coeffs", "h", len(store.coeffs)),
+        (store, "nz", "B", len(store.nz)),
+        (store, "nzMasks", "H", len(store.nzMasks)),
+        (store, "nonZero", "B", len(store.nonZero)),
+        (frame, "aboveNz", "B", len(frame.aboveNz)),
+    )
+
+
+def _reconstruct_arrays(frame):
+    return _parse_arrays(frame)[:4] + (
+        (frame, "yPlane", "B", len(frame.yPlane)),
+        (frame, "uPlane", "B", len(frame.uPlane)),
+        (frame, "vPlane", "B", len(frame.vPlane)),
+    )
+
+
+def _layout(frame, arrays):
+    # (owner, attribute, typecode, offset, size) of the shared arrays laid
+    # out one after the other, followed by the progress counters
+    layout = []
+    o = 0
+    for owner, attr, typecode, length in arrays(frame) + (
+        (None, "progress", "i", frame.macroBlockRows + 1),
+    ):
+        size = length * array(typecode).itemsize
+        layout.append((owner, attr, typecode, o, size))
+        o += (size + 3) & ~3
+    return layout, o
+
+
+def _views(layout, buf):
+    return [
+        buf[o : o + size].cast(typecode) if typecode != "B" else buf[o : o + size]
+        for _, _, typecode, o, size in layout
+    ]
+
+
+def _process_worker(data, frame_size, options, needed, name, arrays, job, first, step):
+    from .vp8decoder import VP8Decoder
+
+    # options make the planes the same size as the caller's
+    frame = VP8Decoder(False, two_pass=True).decode_frame_header(
+        data, frame_size=frame_size, **options
+    )
+    frame.mbRowsNeeded, frame.cropEnd = needed
+    layout, _ = _layout(frame, arrays)
+    shm = SharedMemory(name=name)
+    views = _views(layout, shm.buf)
+    try:
+        for (owner, attr, _, _, _), view in zip(layout, views):
+            if owner is not None:
+                setattr(owner, attr, view)
+        job(frame, first, step, views[-1])
+    finally:
+        # the buffer cannot be closed while views of it exist
+        for view in views:
+            view.release()
+        shm.close()
+
+
+def _run_processes(frame, arrays, job, workers):
+    data = bytes(frame.frame[: frame.frameSize])
+    layout, size = _layout(frame, arrays)
+    shm = SharedMemory(create=True, size=size)
+    try:
+        # the workers start from the arrays as they are now
+        for owner, attr, _, o, size in layout:
+            if owner is not None:
+                shm.buf[o : o + size] = memoryview(getattr(owner, attr)).cast("B")
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [
+                pool.submit(
+                    _process_worker,
+                    data,
+                    frame.frameSize,
+                    {"scale": frame.scale, "luma_only": frame.lumaOnly},
+                    (frame.mbRowsNeeded, frame.cropEnd),
+                    shm.name,
+                    arrays,
+                    job,
+                    w,
+                    workers,
+                )
+                for w in range(workers)
+            ]
+            for j in jobs:
+                j.result()
+
+        for owner, attr, typecode, o, size in layout:
+            if owner is None:
+                continue
+            data = bytes(shm.buf[o : o + size])
+            if typecode == "B":
+                setattr(owner, attr, bytearray(data))
+            else:
+                copy = array(typecode)
+                copy.frombytes(data)
+                setattr(owner, attr, copy)
+    finally:
+        shm.close()
+        shm.unlink()
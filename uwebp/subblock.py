@@ -1,16 +1,7 @@
-from .globals import (
-    COEF_TREE,
-    COEF_BANDS,
-    DEFAULT_ZIG_ZAG_1D,
-    P_CAT_1,
-    P_CAT_2,
-    P_CAT_3,
-    P_CAT_4,
-    P_CAT_5,
-    P_CAT_6,
-    AC_LOOKUP,
-    DC_LOOKUP,
-)
+from array import array
+
+from .blockstore import BlockStore
+from .globals import DCT_CAT_PROBS, DEFAULT_ZIG_ZAG_1D
 from .idct import IDCT
 
 
@@ -31,185 +22,185 @@ class SubBlock:
             return 2
         return -1
 
-    def __init__(self, macro_block, above, left, plane):
+    # all zero coefficients, to clear a block before decoding it
+    NO_TOKENS = array("h", [0] * 16)
+
+    def __init__(self, macro_block, plane, x=0, y=0):
+        # a view of one block of the macroblock's BlockStore
         self.macro_block = macro_block
+        self.store = macro_block.store
         self.plane = plane
-        self.above = above
-        self.left = left
-        self.mode = 0
-        self.tokens = [0] * 16
-        self.dest = None
-        self.diff = None
-        self.predicted = None
-    
-    @micropython.native
-    def dct_extra(self, bc, p):
-        v = 0
-        offset = 0
-        while True:
-            v = (v << 1) + bc.read_bool(p[offset])
-            offset += 1
-            if p[offset] <= 0:
-                break
-        return v
-    
+        # position inside the macroblock, in 4x4 block units
+        self.x = x
+        self.y = y
+        if plane == SubBlock.PLANE.Y1:
+            b = y * 4 + x
+        elif plane == SubBlock.PLANE.U:
+            b = BlockStore.U + y * 2 + x
+        elif plane == SubBlock.PLANE.V:
+            b = BlockStore.V + y * 2 + x
+        else:
+            b = BlockStore.Y2
+        self.block = macro_block.block + b
+
+    @staticmethod
     @micropython.native
-    def decode_sub_block(self, bc, coef_probs, ilc, probs_type, with_y2):
-        start_at = 1 if with_y2 else 0
-        lc = ilc
-        c = 0
-        v = 1
-        skip = False
-
-        while v != 11 and c + start_at < 16:
-            if not skip:
-                v = bc.treed_read(
-                    COEF_TREE, coef_probs[probs_type][COEF_BANDS[c + start_at]][lc]
-                )
+    def decode_tokens(store, block, bc, probs, bands, ctx, n):
+        # Reads the tokens of a block of the store from position n on.
+        # bands[i] is the offset in the flat probs table of the context 0
+        # probabilities of position i, the other contexts follow 11 bytes
+        # apart; bands[16] is a sentinel. Returns the position after the
+        # last nonzero coefficient, or n when the block is empty.
+        tokens = store.coeffs
+        o = block * 16
+        tokens[o : o + 16] = SubBlock.NO_TOKENS
+        read_bool = bc.read_bool
+        p = bands[n] + ctx * 11
+        nz = 0
+        mask = 0
+
+        while n < 16:
+            if not read_bool(probs[p]):
+                return SubBlock.set_nonzero(store, block, nz, mask, n)  # EOB
+
+            while not read_bool(probs[p + 1]):  # DCT_0, no EOB may follow
+                n += 1
+                if n == 16:
+                    return SubBlock.set_nonzero(store, block, nz, mask, 16)
+                p = bands[n]
+
+            if not read_bool(probs[p + 2]):
+                v = 1
+                p = bands[n + 1] + 11
             else:
-                v = bc.treed_read(
-                    COEF_TREE, coef_probs[probs_type][COEF_BANDS[c + start_at]][lc], 1
-                )
-
-            dv = self.decode_token(bc, v)
-            lc = 0
-            skip = False
-
-            if dv not in [-1, 1]:
-                if -1 <= dv <= 1:
-                    if dv == 0:
-                        skip = True
+                if not read_bool(probs[p + 3]):
+                    if not read_bool(probs[p + 4]):
+                        v = 2
+                    else:
+                        v = 3 + read_bool(probs[p + 5])
+                elif not read_bool(probs[p + 6]):
+                    if not read_bool(probs[p + 7]):
+                        v = 5 + read_bool(159)  # DCT_CAT1
+                    else:
+                        v = 7 + 2 * read_bool(165)  # DCT_CAT2
+                        v += read_bool(145)
                 else:
-                    lc = 2
-            else:
-                lc = 1
-
-            if v != 11:
-                self.tokens[DEFAULT_ZIG_ZAG_1D[c + start_at]] = dv
-            c += 1
-    
-    @micropython.native
-    def decode_token(self, bc, v):
-        if v == 5:
-            r = 5 + self.dct_extra(bc, P_CAT_1)
-        elif v == 6:
-            r = 7 + self.dct_extra(bc, P_CAT_2)
-        elif v == 7:
-            r = 11 + self.dct_extra(bc, P_CAT_3)
-        elif v == 8:
-            r = 19 + self.dct_extra(bc, P_CAT_4)
-        elif v == 9:
-            r = 35 + self.dct_extra(bc, P_CAT_5)
-        elif v == 10:
-            r = 67 + self.dct_extra(bc, P_CAT_6)
-        else:
-            r = v
-
-        if v != 0 and v != 11 and bc.read_bit() > 0:
-            r = -r
+                    bit1 = read_bool(probs[p + 8])
+                    cat = 2 * bit1 + read_bool(probs[p + 9 + bit1])
+                    v = 0
+                    for prob in DCT_CAT_PROBS[cat]:
+                        if prob == 0:
+                            break
+                        v += v + read_bool(prob)
+                    v += 3 + (8 << cat)  # DCT_CAT3..DCT_CAT6
+                p = bands[n + 1] + 22
+
+            i = DEFAULT_ZIG_ZAG_1D[n]
+            tokens[o + i] = -v if read_bool(128) else v
+            nz += 1
+            mask |= 1 << i
+            n += 1
+
+        return SubBlock.set_nonzero(store, block, nz, mask, 16)
 
-        return r
+    @staticmethod
+    def set_nonzero(store, block, nz, mask, last):
+        store.nz[block] = nz
+        store.nzMasks[block] = mask
+        return last
 
     def get_tokens(self):
-        return self.tokens
-    
-    @micropython.native
-    def dequant_sub_block(self, frame, dc):
-        adjusted_values = [0] * 16
-
-        for diff in range(16):
-            q_value = AC_LOOKUP[frame.get_q_index()]
-            if diff == 0:
-                q_value = DC_LOOKUP[frame.get_q_index()]
-
-            input_value = self.tokens[diff]
-            adjusted_values[diff] = input_value * q_value
-
-        if dc is not None:
-            adjusted_values[0] = dc
-
-        self.diff = IDCT.idct4x4llm_c(adjusted_values)
+        o = self.block * 16
+        return list(self.store.coeffs[o : o + 16])
 
-    def get_above(self):
-        return self.above
-
-    def get_dest(self):
-        return self.dest if self.dest is not None else [[0] * 4 for _ in range(4)]
-
-    def is_dest(self):
-        return self.dest is not None
-
-    def get_diff(self):
-        return self.diff
+    @staticmethod
+    @micropython.native
+    def dequant(store, block, q, dc):
+        # Returns None when the block has no residual, an int when every
+        # pixel gets the same offset, else the 16 residuals. dc replaces the
+        # block's own DC when its macroblock has a Y2 block.
+        if not store.nz[block] and not dc:
+            return None
+
+        tokens = store.coeffs
+        o = block * 16
+        if dc is None:
+            dc = tokens[o] * q[0]
+
+        mask = store.nzMasks[block] & ~1
+        if not mask:
+            dc = (dc + 4) >> 3
+            return dc if dc else None
 
-    def get_left(self):
-        return self.left
+        adjusted_values = [0] * 16
+        adjusted_values[0] = dc
+        q_value = q[1]
+        i = 1
+        while mask >> i:
+            if tokens[o + i]:
+                adjusted_values[i] = tokens[o + i] * q_value
+            i += 1
+
+        if not mask & ~IDCT.ROW_MASK:
+            return IDCT.idct4x4_row(adjusted_values)
+        elif not mask & ~IDCT.COLUMN_MASK:
+            return IDCT.idct4x4_column(adjusted_values)
+        return IDCT.idct4x4llm_c(adjusted_values)
 
     def get_macro_block(self):
         return self.macro_block
 
     def get_mode(self):
-        return self.mode
+        if self.plane != SubBlock.PLANE.Y1:
+            return 0
+        return self.store.bModes[self.macro_block.index * 16 + self.y * 4 + self.x]
+
+    def set_mode(self, mode):
+        self.store.bModes[self.macro_block.index * 16 + self.y * 4 + self.x] = mode
 
     def get_plane(self):
         return self.plane
-    
-    @micropython.native
-    def get_predict(self, intra_bmode, left):
-        if self.dest is not None:
-            return self.dest
-        elif self.predicted is not None:
-            return self.predicted
-        else:
-            rv = 127
-            if intra_bmode in {0, 2, 6, 5, 8} and left:
-                rv = 129
 
-            return [[rv] * 4 for _ in range(4)]
-    
+    def has_no_zero_token(self):
+        return self.store.nz[self.block] > 0
+
+    @staticmethod
     @micropython.native
-    def get_macro_block_predict(self, intra_mode):
-        if self.dest is not None:
-            return self.dest
+    def predict(frame, buf, o, stride, mode, mb_x, mb_y, x, y):
+        # B_PRED prediction of luma block (x, y) of macroblock (mb_x, mb_y),
+        # written at offset o of the plane
+        top = o - stride
+
+        # Edge pixels come straight from the plane; outside the frame the
+        # row above is 127 and the column to the left is 129.
+        if mb_y == 0 and y == 0:
+            above = [127] * 4
+            al = 127
         else:
-            rv = 127
-            if intra_mode == 2:
-                rv = 129
+            above = buf[top : top + 4]
+            al = 129 if mb_x == 0 and x == 0 else buf[top - 1]
 
-            return [[rv] * 4 for _ in range(4)]
+        if mb_x == 0 and x == 0:
+            left = [129] * 4
+        else:
+            left = [buf[o - 1 + i * stride] for i in range(4)]
 
-    def has_no_zero_token(self):
-        return any(token != 0 for token in self.tokens)
-    
-    @micropython.native
-    def predict(self, frame):
-        # Get above and left SubBlocks
-        above_sb = frame.get_above_sub_block(self, self.get_plane())
-        left_sb = frame.get_left_sub_block(self, self.get_plane())
-
-        # Get pixel values from above and left SubBlocks
-        above = [above_sb.get_predict(self.get_mode(), False)[i][3] for i in range(4)]
-        left = [left_sb.get_predict(self.get_mode(), True)[3][i] for i in range(4)]
-
-        # Calculate AL and AR
-        AL = frame.get_left_sub_block(above_sb, self.get_plane())
-        ar = [
-            frame.get_above_right_sub_block(self, self.plane).get_predict(
-                self.get_mode(), False
-            )[i][3]
-            for i in range(4)
-        ]
-
-        al = AL.get_predict(
-            self.get_mode(), not left_sb.is_dest() and not above_sb.is_dest()
-        )[3][3]
+        if x < 3:
+            ar = [127] * 4 if mb_y == 0 and y == 0 else buf[top + 4 : top + 8]
+        elif mb_y == 0:
+            ar = [127] * 4
+        else:
+            # the right column reuses the pixels above-right of the macroblock
+            top = o - (y * 4 + 1) * stride - x * 4 + 16
+            if mb_x == frame.macroBlockCols - 1:
+                ar = [buf[top - 1]] * 4
+            else:
+                ar = buf[top : top + 4]
 
         # Initialize prediction matrix p
         p = [[0] * 4 for _ in range(4)]
 
         # Switch based on prediction mode
-        mode = self.get_mode()
-
         if mode == 0:
             expected_dc = sum(above) + sum(left) + 4
             expected_dc = expected_dc >> 3
@@ -226,8 +217,11 @@ class SubBlock:
                     p[i][j] = r
 
         elif mode == 2:
-            ap = [(al + 2 * above[i] + above[i + 1] + 2) >> 2 for i in range(3)] + [
-                (above[2] + 2 * above[3] + ar[0] + 2) >> 2
+            ap = [
+                (al + 2 * above[0] + above[1] + 2) >> 2,
+                (above[0] + 2 * above[1] + above[2] + 2) >> 2,
+                (above[1] + 2 * above[2] + above[3] + 2) >> 2,
+                (above[2] + 2 * above[3] + ar[0] + 2) >> 2,
             ]
 
             for i in range(4):
@@ -235,8 +229,11 @@ class SubBlock:
                     p[i][j] = ap[i]
 
         elif mode == 3:
-            lp = [(al + 2 * left[i] + left[i + 1] + 2) >> 2 for i in range(3)] + [
-                (left[2] + 2 * left[3] + left[3] + 2) >> 2
+            lp = [
+                (al + 2 * left[0] + left[1] + 2) >> 2,
+                (left[0] + 2 * left[1] + left[2] + 2) >> 2,
+                (left[1] + 2 * left[2] + left[3] + 2) >> 2,
+                (left[2] + 2 * left[3] + left[3] + 2) >> 2,
             ]
 
             for i in range(4):
@@ -348,52 +345,41 @@ class SubBlock:
             print("TODO:", mode)
             exit(0)
 
-        self.set_predict(p)
-    
-    @micropython.native
-    def reconstruct(self):
-        p = self.get_predict(1, False)
-        dest = [[0 for _ in range(4)] for _ in range(4)]
-        diff = self.get_diff()
+        for j in range(4):
+            for i in range(4):
+                buf[o + i] = p[i][j]
+            o += stride
 
+    @staticmethod
+    @micropython.native
+    def reconstruct(buf, o, stride, diff):
+        # adds a residual from dequant() to the predicted block at offset o
+        if diff is None:
+            return
+
+        if isinstance(diff, int):
+            for r in range(4):
+                for c in range(4):
+                    a = buf[o + c] + diff
+                    if a < 0:
+                        a = 0
+                    elif a > 255:
+                        a = 255
+                    buf[o + c] = a
+                o += stride
+            return
+
+        d = 0
         for r in range(4):
             for c in range(4):
-                a = diff[r][c] + p[r][c]
-                a = max(0, min(255, a))
-                dest[r][c] = a
-
-        self.set_dest(dest)
-
-    def set_dest(self, dest):
-        self.dest = dest
-
-    def set_diff(self, diff):
-        self.diff = diff
-
-    def set_mode(self, mode):
-        self.mode = mode
-    
-    def set_pixel(self, x, y, p):
-        if self.dest is None:
-            self.dest = [[0] * 4 for _ in range(4)]
-        self.dest[x][y] = p
-
-    def set_predict(self, predict):
-        self.predicted = predict
+                a = buf[o + c] + diff[d + c]
+                if a < 0:
+                    a = 0
+                elif a > 255:
+                    a = 255
+                buf[o + c] = a
+            o += stride
+            d += 4
 
     def __str__(self):
-        return "[" + " ".join(str(token) for token in self.tokens) + "]"
-
-    def draw_debug_v(self):
-        if self.dest is not None:
-            self.dest[0][0] = 0
-            self.dest[0][1] = 0
-            self.dest[0][2] = 0
-            self.dest[0][3] = 0
-
-    def draw_debug_h(self):
-        if self.dest is not None:
-            self.dest[0][0] = 0
-            self.dest[1][0] = 0
-            self.dest[2][0] = 0
-            self.dest[3][0] = 0
+        return "[" + " ".join(str(token) for token in self.get_tokens()) + "]"
@@ -9,12 +9,21 @@ from .globals import (
     KF_UV_MODE_PROB,
     VP8_KF_YMODE_TREE,
     KF_YMODE_PROB,
-    COEF_UPDATE_PROBS,
-    DEFAULT_COEF_PROBS,
+    COEF_BANDS,
+    COEF_PROBS_SIZE,
+    COEF_UPDATE_PROBS_FLAT,
+    DEFAULT_COEF_PROBS_FLAT,
+    AC_LOOKUP,
+    DC_LOOKUP,
 )
-from .booldecoder import BoolDecoder
+from .booldecoder import BoolDecoder, WINDOW_BYTES
+from .loopfilter import LoopFilter
+from .blockstore import BlockStore
 from .macroblock import MacroBlock
-from .subblock import SubBlock
+
+# B_PRED equivalent of each 16x16 luma mode (DC, V, H, TM), which is what
+# the mode contexts of the neighbouring subblocks see
+_Y_TO_B_MODE = (0, 2, 3, 1)
 
 
 class DeltaQ:
@@ -23,6 +32,24 @@ class DeltaQ:
         self.update = False
 
 
+class DequantFactors:
+    # [dc, ac] multipliers for each coefficient type of one segment
+    def __init__(self, q, y1dc, y2dc, y2ac, uvdc, uvac):
+        self.y1 = [DC_LOOKUP[self.clip(q + y1dc, 127)], AC_LOOKUP[self.clip(q, 127)]]
+        self.y2 = [
+            DC_LOOKUP[self.clip(q + y2dc, 127)] * 2,
+            max(8, AC_LOOKUP[self.clip(q + y2ac, 127)] * 155 // 100),
+        ]
+        self.uv = [
+            DC_LOOKUP[self.clip(q + uvdc, 117)],
+            AC_LOOKUP[self.clip(q + uvac, 127)],
+        ]
+
+    @staticmethod
+    def clip(q, max_q):
+        return 0 if q < 0 else max_q if q > max_q else q
+
+
 class VP8Frame:
     MAX_REF_LF_DELTAS = 4
     MAX_MODE_LF_DELTAS = 4
@@ -30,10 +57,48 @@ class VP8Frame:
     COEF_BANDS = 8
     PREV_COEF_CONTEXTS = 3
     MAX_ENTROPY_TOKENS = 12
-
-    def __init__(self, frame, coef_probs):
+    MAX_MB_SEGMENTS = 4
+    NZ_CONTEXTS = 9
+    # supported output scales and their shifts
+    SCALES = {1: 0, 1 / 2: 1, 1 / 4: 2, 1 / 8: 3}
+
+    def __init__(
+        self,
+        frame,
+        coef_probs,
+        loop_filter=True,
+        frame_size=-1,
+        low_memory=False,
+        two_pass=False,
+        parallel=None,
+        scale=1,
+        luma_only=False,
+    ):
+        # parallel parsing fills the coefficient store of a two-pass frame
+        two_pass = two_pass or parallel is not None
+        if low_memory and two_pass:
+            raise ValueError("low_memory and two_pass cannot be combined")
+        if scale not in self.SCALES:
+            raise ValueError("Unsupported scale: " + str(scale))
         self.frame = frame
+        # the whole frame size, data may still be arriving when it is larger
+        self.frameSize = len(frame) if frame_size < 0 else frame_size
         self.coef_probs = coef_probs
+        # output 1 << scaleShift times smaller in each direction
+        self.scale = scale
+        self.scaleShift = self.SCALES[scale]
+        # reconstruct the Y plane only; chroma tokens are still parsed
+        self.lumaOnly = luma_only
+        self.loopFilterEnabled = loop_filter
+        # keep only the macroblock and pixel rows decoding still needs
+        self.lowMemory = low_memory
+        # parse the coefficients of every row before reconstructing any
+        self.twoPass = two_pass
+        self.mbRowsParsed = 0
+        # "thread" or "process" to parse the token partitions and
+        # reconstruct the rows concurrently
+        self.parallel = parallel
+        self.loopFilter = None
         self.qIndex = 0
         self.mb_no_coeff_skip = 0
         self.macroBlockRows = 0
@@ -42,10 +107,42 @@ class VP8Frame:
         self.segmentation_enabled = 0
         self.tokenBoolDecoder = None
         self.tokenBoolDecoders = []
-        self.macroBlocks = None
+        self.partitionOffsets = []
+        self.partitionEnds = []
+        self.coefBands = None
+        self.blocks = None
+        self.modeBoolDecoder = None
+        self.probSkipFalse = 0
+        self.aboveNz = None
+        self.leftNz = None
+        self.aboveModes = None
+        self.leftModes = None
+        self.yPlane = None
+        self.uPlane = None
+        self.vPlane = None
+        # first macroblock row held by the planes and how many they hold
+        self.planeRow = 0
+        self.planeRows = 0
+        self.yStride = 0
+        self.uvStride = 0
+        # Macroblock rows that have to be reconstructed, and one past the
+        # last column needed in row 0 (see set_crop()). Both cover the whole
+        # frame unless it is cropped.
+        self.crop = None
+        self.mbRowsNeeded = 0
+        self.cropEnd = 0
+        # reduced planes of a scaled frame
+        self.yScaled = None
+        self.uScaled = None
+        self.vScaled = None
+        self.yScaledStride = 0
+        self.uvScaledStride = 0
         self.filterLevel = 0
         self.filterType = 0
         self.sharpnessLevel = 0
+        self.modeRefLfDeltaEnabled = 0
+        self.refLfDeltas = None
+        self.modeLfDeltas = None
         self.frameType = 0
         self.width = 0
         self.height = 0
@@ -53,6 +150,9 @@ class VP8Frame:
         self.mb_segment_tree_probs = None
         self.update_mb_segmentation_map = 0
         self.update_mb_segmentaton_data = 0
+        self.segmentQuantizers = [0] * self.MAX_MB_SEGMENTS
+        self.segmentFilterLevels = [0] * self.MAX_MB_SEGMENTS
+        self.dequantFactors = None
 
     def get_sharpness_level(self):
         return self.sharpnessLevel
@@ -61,19 +161,128 @@ class VP8Frame:
         return self.frameType
 
     def create_macro_blocks(self):
-        self.macroBlocks = [
-            [MacroBlock(x, y) for y in range(self.macroBlockRows + 2)]
-            for x in range(self.macroBlockCols + 2)
+        # low-memory frames reuse two rows: the one being decoded and the
+        # one above it, which the loop filter still needs
+        rows = self.macroBlockRows
+        if self.lowMemory:
+            rows = min(rows, 2)
+        self.blocks = BlockStore(
+            self.macroBlockCols, rows, self.macroBlockRows if self.twoPass else 1
+        )
+
+        # Token contexts: whether the nearest block above (per column) and to
+        # the left (in the current row) had coefficients. Every macroblock
+        # column holds NZ_CONTEXTS entries: 4 Y, 2 U, 2 V and Y2.
+        self.aboveNz = bytearray(self.macroBlockCols * self.NZ_CONTEXTS)
+        self.leftNz = bytearray(self.NZ_CONTEXTS)
+        # subblock modes of the luma row above and of the column to the left,
+        # the contexts of B_PRED mode probabilities
+        self.aboveModes = bytearray(self.macroBlockCols * 4)
+        self.leftModes = bytearray(4)
+
+    def create_planes(self):
+        # row-major planes covering whole macroblocks; the visible image is
+        # the top-left width x height corner
+        rows = self.macroBlockRows
+        if self.lowMemory or (self.scaleShift and not self.twoPass):
+            # The row being decoded and the one above it for prediction. With
+            # the loop filter the row above that one is still being filtered.
+            rows = min(rows, 3 if self.loopFilterEnabled else 2)
+        self.planeRows = rows
+        chroma_rows = 0 if self.lumaOnly else rows
+        self.yStride = self.macroBlockCols * 16
+        self.uvStride = self.macroBlockCols * 8
+        self.yPlane = bytearray(self.yStride * rows * 16)
+        self.uPlane = bytearray(self.uvStride * chroma_rows * 8)
+        self.vPlane = bytearray(self.uvStride * chroma_rows * 8)
+
+        # A scaled frame is still reconstructed at full size, as prediction
+        # needs the exact pixels around each block. Every finished row is
+        # then averaged down into planes of the whole reduced picture.
+        if self.scaleShift:
+            rows = self.macroBlockRows
+            chroma_rows = 0 if self.lumaOnly else rows
+            size = 16 >> self.scaleShift
+            self.yScaledStride = self.macroBlockCols * size
+            self.uvScaledStride = self.yScaledStride >> 1
+            self.yScaled = bytearray(self.yScaledStride * rows * size)
+            self.uScaled = bytearray(self.uvScaledStride * chroma_rows * (size >> 1))
+            self.vScaled = bytearray(self.uvScaledStride * chroma_rows * (size >> 1))
+
+    def scroll_planes(self):
+        # drop the oldest macroblock row to make room for the next one
+        for plane, size in (
+            (self.yPlane, self.yStride * 16),
+            (self.uPlane, self.uvStride * 8),
+            (self.vPlane, self.uvStride * 8),
+        ):
+            view = memoryview(plane)
+            view[:-size] = view[size:]
+        self.planeRow += 1
+
+    def scale_row(self, mb_row):
+        # averages the visible part of a finished macroblock row down into
+        # the reduced planes
+        shift = self.scaleShift
+        plane_row = mb_row - self.planeRow
+        cols = self.get_needed_cols(mb_row)
+        planes = [
+            (self.yPlane, self.yStride, self.yScaled, self.yScaledStride, 16, 0)
         ]
+        if not self.lumaOnly:
+            planes.append(
+                (self.uPlane, self.uvStride, self.uScaled, self.uvScaledStride, 8, 1)
+            )
+            planes.append(
+                (self.vPlane, self.uvStride, self.vScaled, self.uvScaledStride, 8, 1)
+            )
+        for src, stride, dst, dst_stride, size, sub in planes:
+            width = (self.width + sub) >> sub
+            height = (self.height + sub) >> sub
+            VP8Frame.box_filter(
+                src,
+                plane_row * size * stride,
+                stride,
+                dst,
+                mb_row * (size >> shift) * dst_stride,
+                dst_stride,
+                min(cols * size, width),
+                min(size, height - mb_row * size),
+                shift,
+            )
+
+    @staticmethod
+    @micropython.native
+    def box_filter(src, o, stride, dst, d, dst_stride, width, height, shift):
+        # each 1 << shift square of the width x height area at src[o] becomes
+        # its rounded mean at dst[d]; the squares cut by the right and bottom
+        # edges average only the pixels inside them
+        n = 1 << shift
+        columns = (width + n - 1) >> shift
+        sums = [0] * columns
+        src = memoryview(src)
+        y = 0
+        while y < height:
+            rows = min(n, height - y)
+            for x in range(columns):
+                sums[x] = 0
+            for _ in range(rows):
+                for x in range(columns):
+                    a = o + (x << shift)
+                    sums[x] += sum(src[a : min(a + n, o + width)])
+                o += stride
+            for x in range(columns):
+                count = rows * min(n, width - (x << shift))
+                dst[d + x] = (sums[x] + (count >> 1)) // count
+            d += dst_stride
+            y += n
 
     @staticmethod
     @micropython.native
     def get_delta_q(bc, prev):
         ret = DeltaQ()
         if bc.read_bit() > 0:
-            ret.v = bc.read_literal(4)
-            if bc.read_bit() > 0:
-                ret.v = -ret.v
+            ret.v = bc.read_signed(4)
 
         if ret.v != prev:
             ret.update = True
@@ -85,8 +294,24 @@ class VP8Frame:
         r = data & (1 << bit)
         return 1 if r > 0 else 0
     
-    @micropython.native
     def decode_frame(self, debug=False):
+        if not self.decode_frame_header(debug):
+            return False
+
+        if self.twoPass:
+            self.parse_frame()
+            self.reconstruct_frame()
+        else:
+            for mb_row in range(self.macroBlockRows):
+                self.decode_macro_block_row(mb_row)
+
+        if debug:
+            self.draw_debug()
+
+        return True
+
+    @micropython.native
+    def decode_frame_header(self, debug=False):
         ref_lf_deltas = [0] * self.MAX_REF_LF_DELTAS
         mode_lf_deltas = [0] * self.MAX_MODE_LF_DELTAS
         offset = 0
@@ -173,13 +398,18 @@ class VP8Frame:
 
             self.macroBlockRows = t_height >> 4
             self.macroBlockCols = t_width >> 4
+            self.mbRowsNeeded = self.macroBlockRows
+            self.cropEnd = self.macroBlockCols + self.macroBlockRows
             if debug:
                 print(
                     f"macroBlockCols: {self.macroBlockCols} macroBlockRows: {self.macroBlockRows}"
                 )
 
             self.create_macro_blocks()
-            bc = BoolDecoder(self.frame, var29)
+            self.create_planes()
+            bc = BoolDecoder(
+                self.frame, var29, var29 + first_partition_length_in_bytes
+            )
             if self.frameType == 0:
                 mode_ref_lf_delta_enabled = bc.read_bit()
                 if debug:
@@ -204,25 +434,27 @@ class VP8Frame:
 
                 if self.update_mb_segmentaton_data > 0:
                     self.mb_segement_abs_delta = bc.read_bit()
+                    # quantizer, then loop filter level, of each segment
                     for mode_ref_lf_delta_enabled in range(2):
-                        for Qindex in range(4):
+                        data = (self.segmentQuantizers, self.segmentFilterLevels)[
+                            mode_ref_lf_delta_enabled
+                        ]
+                        for Qindex in range(self.MAX_MB_SEGMENTS):
+                            q_update = 0
                             if bc.read_bit() > 0:
-                                q_update = bc.read_literal(
+                                q_update = bc.read_signed(
                                     VP8_MB_FEATURE_DATA_BITS[mode_ref_lf_delta_enabled]
                                 )
-                                if bc.read_bit() > 0:
-                                    q_update = -q_update
+                            data[Qindex] = q_update
 
-                    if self.update_mb_segmentation_map > 0:
-                        self.mb_segment_tree_probs = [0] * 3
-                        for mode_ref_lf_delta_enabled in range(3):
-                            if bc.read_bit() > 0:
-                                Qindex = bc.read_literal(8)
-                            else:
-                                Qindex = 255
-                            self.mb_segment_tree_probs[mode_ref_lf_delta_enabled] = (
-                                Qindex
-                            )
+                if self.update_mb_segmentation_map > 0:
+                    self.mb_segment_tree_probs = [0] * 3
+                    for mode_ref_lf_delta_enabled in range(3):
+                        if bc.read_bit() > 0:
+                            Qindex = bc.read_literal(8)
+                        else:
+                            Qindex = 255
+                        self.mb_segment_tree_probs[mode_ref_lf_delta_enabled] = Qindex
 
             self.filterType = bc.read_bit()
             if debug:
@@ -245,20 +477,22 @@ class VP8Frame:
                 if Qindex > 0:
                     for q_update in range(self.MAX_REF_LF_DELTAS):
                         if bc.read_bit() > 0:
-                            ref_lf_deltas[q_update] = bc.read_literal(6)
-                            if bc.read_bit() > 0:
-                                ref_lf_deltas[q_update] *= -1
+                            ref_lf_deltas[q_update] = bc.read_signed(6)
                             if debug:
                                 print(f"ref_lf_deltas[i]: {ref_lf_deltas[q_update]}")
 
                     for q_update in range(self.MAX_MODE_LF_DELTAS):
                         if bc.read_bit() > 0:
-                            mode_lf_deltas[q_update] = bc.read_literal(6)
-                            if bc.read_bit() > 0:
-                                mode_lf_deltas[q_update] *= -1
+                            mode_lf_deltas[q_update] = bc.read_signed(6)
                             if debug:
                                 print(f"mode_lf_deltas[i]: {mode_lf_deltas[q_update]}")
 
+            self.modeRefLfDeltaEnabled = mode_ref_lf_delta_enabled
+            self.refLfDeltas = ref_lf_deltas
+            self.modeLfDeltas = mode_lf_deltas
+            if self.loopFilterEnabled and self.filterLevel > 0:
+                self.loopFilter = LoopFilter(self)
+
             if debug:
                 print(f"offset: {var29}")
 
@@ -301,6 +535,24 @@ class VP8Frame:
             if debug:
                 print(f"uvac_delta_q: {uvac_delta_q} q_update: {var31}")
 
+            self.dequantFactors = []
+            for i in range(self.MAX_MB_SEGMENTS):
+                q = Qindex
+                if self.segmentation_enabled > 0:
+                    q = self.segmentQuantizers[i]
+                    if self.mb_segement_abs_delta == 0:
+                        q += Qindex
+                self.dequantFactors.append(
+                    DequantFactors(
+                        q,
+                        y1dc_delta_q,
+                        y2dc_delta_q,
+                        y2ac_delta_q,
+                        uvdc_delta_q,
+                        uvac_delta_q,
+                    )
+                )
+
             if self.frameType != 0:
                 raise ValueError("bad input: not intra")
             else:
@@ -316,18 +568,12 @@ class VP8Frame:
                 if debug:
                     print(f"refresh_last_frame: {refresh_last_frame}")
 
-                for ibc in range(self.BLOCK_TYPES):
-                    for num_part in range(self.COEF_BANDS):
-                        for mb_row in range(self.PREV_COEF_CONTEXTS):
-                            for l in range(self.MAX_ENTROPY_TOKENS - 1):
-                                if (
-                                    bc.read_bool(
-                                        COEF_UPDATE_PROBS[ibc][num_part][mb_row][l]
-                                    )
-                                    > 0
-                                ):
-                                    newp = bc.read_literal(8)
-                                    self.coef_probs[ibc][num_part][mb_row][l] = newp
+                coef_probs = self.coef_probs
+                for i in range(COEF_PROBS_SIZE):
+                    if bc.read_bool(COEF_UPDATE_PROBS_FLAT[i]) > 0:
+                        coef_probs[i] = bc.read_literal(8)
+
+                self.setup_coef_bands()
 
                 self.mb_no_coeff_skip = bc.read_bit()
                 if debug:
@@ -335,24 +581,6 @@ class VP8Frame:
 
                 if self.frameType == 0:
                     self.read_modes(bc)
-                    ibc = 0
-                    num_part = 1 << self.multiTokenPartition
-                    if debug:
-                        print("num_part:", num_part)
-
-                    for mb_row in range(self.macroBlockRows):
-                        if num_part > 1:
-                            self.tokenBoolDecoder = self.tokenBoolDecoders[ibc]
-                            self.decode_macro_block_row(mb_row)
-                            ibc += 1
-                            if ibc == num_part:
-                                ibc = 0
-                        else:
-                            self.decode_macro_block_row(mb_row)
-
-                    if debug:
-                        self.draw_debug()
-
                     return True
                 else:
                     raise ValueError("bad input: not intra")
@@ -360,7 +588,7 @@ class VP8Frame:
     def draw_debug(self):
         for mb_row in range(self.macroBlockRows):
             for mb_col in range(self.macroBlockCols):
-                self.macroBlocks[mb_col + 1][mb_row + 1].draw_debug()
+                self.get_macro_block(mb_col, mb_row).draw_debug(self)
 
     def get_filter_type(self):
         return self.filterType
@@ -369,85 +597,139 @@ class VP8Frame:
         return self.filterLevel
 
     def decode_macro_block_row(self, mbRow):
-        for mb_col in range(self.macroBlockCols):
-            mb = self.get_macro_block(mb_col, mbRow)
-            mb.decode_macro_block(self)
-            mb.dequant_macro_block(self)
-    
-    @micropython.native
-    def get_above_right_sub_block(self, sb, plane):
-        mb = sb.get_macro_block()
-        x = mb.get_subblock_x(sb)
-        y = mb.get_subblock_y(sb)
-        if plane == SubBlock.PLANE.Y1:
-            if y == 0 and x < 3:
-                var12 = self.get_macro_block(mb.get_x(), mb.get_y() - 1)
-                r = var12.get_sub_block(plane, x + 1, 3)
-                return r
-            elif y == 0 and x == 3:
-                var12 = self.get_macro_block(mb.get_x() + 1, mb.get_y() - 1)
-                r = var12.get_sub_block(plane, 0, 3)
-                if var12.get_x() == self.get_macro_block_cols():
-                    dest = [
-                        [
-                            (
-                                127
-                                if var12.get_y() < 0
-                                else self.get_macro_block(mb.get_x(), mb.get_y() - 1)
-                                .get_sub_block(SubBlock.PLANE.Y1, 3, 3)
-                                .get_dest()[3][3]
-                            )
-                            for _ in range(4)
-                        ]
-                        for _ in range(4)
-                    ]
-                    r = SubBlock(var12, None, None, SubBlock.PLANE.Y1)
-                    r.set_dest(dest)
-                return r
-            elif y > 0 and x < 3:
-                r = mb.get_sub_block(plane, x + 1, y - 1)
-                return r
-            else:
-                sb2 = mb.get_sub_block(sb.get_plane(), 3, 0)
-                return self.get_above_right_sub_block(sb2, plane)
+        if self.parallel is not None:
+            # the wavefront reconstructs all rows at once
+            if mbRow == 0:
+                self.parse_frame()
+                self.reconstruct_frame()
+            return
+
+        if self.twoPass:
+            self.parse_frame()
         else:
-            raise ValueError("bad input: get_above_right_sub_block()")
-    
-    @micropython.native
-    def get_above_sub_block(self, sb, plane):
-        r = sb.get_above()
-        if r is None:
-            mb = sb.get_macro_block()
-            x = mb.get_subblock_x(sb)
-
-            mb2 = self.get_macro_block(mb.get_x(), mb.get_y() - 1)
-            while plane == SubBlock.PLANE.Y2 and mb2.get_y_mode() == 4:
-                mb2 = self.get_macro_block(mb2.get_x(), mb2.get_y() - 1)
-
-            r = mb2.get_bottom_subblock(x, sb.get_plane())
-
-        return r
+            self.parse_macro_block_row(mbRow)
+        self.reconstruct_macro_block_row(mbRow)
+
+    def parse_frame(self):
+        # first pass of a two-pass frame: the modes and coefficients of
+        # every row that has not been parsed yet
+        if (
+            self.parallel is not None
+            and self.mbRowsParsed == 0
+            and len(self.tokenBoolDecoders) > 1
+        ):
+            # imported here so that serial decoding never loads it
+            from .parallel import parse_partitions
+
+            parse_partitions(self, self.parallel)
+            self.mbRowsParsed = self.macroBlockRows
+
+        while self.mbRowsParsed < self.mbRowsNeeded:
+            self.parse_macro_block_row(self.mbRowsParsed)
+            self.mbRowsParsed += 1
+
+    def reconstruct_frame(self):
+        # Second pass. The pixels only depend on the parsed data, so a
+        # two-pass frame can be reconstructed again without reparsing.
+        if self.parallel is not None:
+            from .parallel import reconstruct_rows
+
+            reconstruct_rows(self, self.parallel)
+            if self.loopFilter is not None:
+                for mb_row in range(self.mbRowsNeeded):
+                    self.loopFilter.filter_row(mb_row)
+            if self.scaleShift:
+                for mb_row in range(self.mbRowsNeeded):
+                    self.scale_row(mb_row)
+            return
+
+        for mb_row in range(self.mbRowsNeeded):
+            self.reconstruct_macro_block_row(mb_row)
+
+    def parse_macro_block_row(self, mbRow):
+        bc = self.tokenBoolDecoders[mbRow & (len(self.tokenBoolDecoders) - 1)]
+        self.tokenBoolDecoder = bc
+        left = self.leftNz
+        for i in range(self.NZ_CONTEXTS):
+            left[i] = 0
+
+        if self.lowMemory:
+            self.read_mode_row(self.modeBoolDecoder, mbRow)
 
+        for mb_col in range(self.macroBlockCols):
+            self.get_macro_block(mb_col, mbRow).decode_macro_block(self, bc, left)
+
+    def reconstruct_macro_block_row(self, mbRow):
+        if mbRow - self.planeRow == self.planeRows:
+            self.scroll_planes()
+
+        for mb_col in range(self.get_needed_cols(mbRow)):
+            self.get_macro_block(mb_col, mbRow).dequant_macro_block(self)
+
+        # The filter trails reconstruction by one row: predicting this row
+        # needed the unfiltered bottom pixels of the row above.
+        last = self.mbRowsNeeded - 1
+        if self.loopFilter is not None:
+            if mbRow > 0:
+                self.loopFilter.filter_row(mbRow - 1)
+            if mbRow == last:
+                self.loopFilter.filter_row(mbRow)
+
+        if self.scaleShift:
+            # rows are scaled once final, see get_finished_rows()
+            if self.loopFilter is None:
+                self.scale_row(mbRow)
+            elif mbRow == last:
+                for mb_row in range(max(0, mbRow - 2), mbRow + 1):
+                    self.scale_row(mb_row)
+            elif mbRow > 1:
+                self.scale_row(mbRow - 2)
+
+    def get_finished_rows(self, mb_rows):
+        # macroblock rows whose pixels are final once mb_rows rows have been
+        # reconstructed; filtering a row still changes the row above it
+        if self.loopFilter is None or mb_rows >= self.mbRowsNeeded:
+            return mb_rows
+        return max(0, mb_rows - 2)
+
+    def set_crop(self, x, y, w, h):
+        # Only the [x, x + w) x [y, y + h) window of the (scaled) picture
+        # will be read: rows below it are never decoded, and only the
+        # macroblocks it depends on are reconstructed. Prediction reads the
+        # macroblocks to the left, above and above-right, so each row needs
+        # every column up to one more than the row below it. The loop filter
+        # of the row below the window and of the column right of it still
+        # changes pixels inside, which adds a row and a column.
+        shift = self.scaleShift
+        right = (((x + w) << shift) - 1) >> 4
+        bottom = (((y + h) << shift) - 1) >> 4
+        extra = 0 if self.loopFilter is None else 1
+        self.crop = (x, y, w, h)
+        self.mbRowsNeeded = min(bottom + 1 + extra, self.macroBlockRows)
+        self.cropEnd = right + 1 + bottom + extra
+
+    def get_needed_cols(self, mb_row):
+        # macroblocks at the start of mb_row that are reconstructed
+        return min(self.macroBlockCols, self.cropEnd - mb_row)
+    
     def get_coef_probs(self):
         return self.coef_probs
-    
-    @micropython.native
-    def get_left_sub_block(self, sb, plane):
-        r = sb.get_left()
-        if r is None:
-            mb = sb.get_macro_block()
-            y = mb.get_subblock_y(sb)
-
-            mb2 = self.get_macro_block(mb.get_x() - 1, mb.get_y())
-            while plane == SubBlock.PLANE.Y2 and mb2.get_y_mode() == 4:
-                mb2 = self.get_macro_block(mb2.get_x() - 1, mb2.get_y())
-
-            r = mb2.get_right_subblock(y, sb.get_plane())
 
-        return r
+    def setup_coef_bands(self):
+        # offsets into coef_probs of the context 0 probabilities of each
+        # coefficient position, with a sentinel for position 16
+        size = self.PREV_COEF_CONTEXTS * (self.MAX_ENTROPY_TOKENS - 1)
+        self.coefBands = [
+            [(t * self.COEF_BANDS + COEF_BANDS[i]) * size for i in range(16)]
+            + [t * self.COEF_BANDS * size]
+            for t in range(self.BLOCK_TYPES)
+        ]
 
+    def get_coef_bands(self, probs_type):
+        return self.coefBands[probs_type]
+    
     def get_macro_block(self, mbCol, mbRow):
-        return self.macroBlocks[mbCol + 1][mbRow + 1]
+        return MacroBlock(self, mbCol, mbRow)
 
     def get_macro_block_cols(self):
         return self.macroBlockCols
@@ -458,111 +740,123 @@ class VP8Frame:
     def get_q_index(self):
         return self.qIndex
 
+    def get_dequant_factors(self, segment):
+        return self.dequantFactors[segment]
+
     def get_token_bool_decoder(self):
         return self.tokenBoolDecoder
     
-    @micropython.native
-    def get_u_buffer(self):
-        r = [[0] * (self.macroBlockRows * 8) for _ in range(self.macroBlockCols * 8)]
-        for y in range(self.macroBlockRows):
-            for x in range(self.macroBlockCols):
-                mb = self.macroBlocks[x + 1][y + 1]
-                for b in range(2):
-                    for a in range(2):
-                        sb = mb.get_u_sub_block(a, b)
-                        for d in range(4):
-                            for c in range(4):
-                                r[x * 8 + a * 4 + c][y * 8 + b * 4 + d] = sb.get_dest()[
-                                    c
-                                ][d]
-        return r
-    
-    @micropython.native
-    def get_v_buffer(self):
-        r = [[0] * (self.macroBlockRows * 8) for _ in range(self.macroBlockCols * 8)]
-        for y in range(self.macroBlockRows):
-            for x in range(self.macroBlockCols):
-                mb = self.macroBlocks[x + 1][y + 1]
-                for b in range(2):
-                    for a in range(2):
-                        sb = mb.get_v_sub_block(a, b)
-                        for d in range(4):
-                            for c in range(4):
-                                r[x * 8 + a * 4 + c][y * 8 + b * 4 + d] = sb.get_dest()[
-                                    c
-                                ][d]
-        return r
-    
-    @micropython.native
-    def get_y_buffer(self):
-        r = [[0] * (self.macroBlockRows * 16) for _ in range(self.macroBlockCols * 16)]
-        for y in range(self.macroBlockRows):
-            for x in range(self.macroBlockCols):
-                mb = self.macroBlocks[x + 1][y + 1]
-                for b in range(4):
-                    for a in range(4):
-                        sb = mb.get_y_sub_block(a, b)
-                        for d in range(4):
-                            for c in range(4):
-                                r[x * 16 + a * 4 + c][
-                                    y * 16 + b * 4 + d
-                                ] = sb.get_dest()[c][d]
-        return r
-    
-    @micropython.native
+    def get_y_stride(self):
+        # stride of the planes returned by get_y_buffer()
+        return self.yScaledStride if self.scaleShift else self.yStride
+
+    def get_uv_stride(self):
+        return self.uvScaledStride if self.scaleShift else self.uvStride
+
+    def get_plane_rows(self, plane, stride, size, first_row, last_row):
+        if last_row < 0:
+            last_row = self.macroBlockRows
+        if first_row < self.planeRow:
+            raise ValueError("Rows already discarded in low-memory mode")
+        first_row -= self.planeRow
+        last_row -= self.planeRow
+        return memoryview(plane)[
+            first_row * size * stride : last_row * size * stride
+        ]
+
+    def get_scaled_rows(self, plane, stride, size, first_row, last_row):
+        # the reduced planes hold every row of the picture
+        if last_row < 0:
+            last_row = self.macroBlockRows
+        size >>= self.scaleShift
+        return memoryview(plane)[first_row * size * stride : last_row * size * stride]
+
+    def get_u_buffer(self, first_row=0, last_row=-1):
+        if self.lumaOnly:
+            raise ValueError("Chroma is not decoded in luma-only mode")
+        if self.scaleShift:
+            return self.get_scaled_rows(
+                self.uScaled, self.uvScaledStride, 8, first_row, last_row
+            )
+        return self.get_plane_rows(self.uPlane, self.uvStride, 8, first_row, last_row)
+
+    def get_v_buffer(self, first_row=0, last_row=-1):
+        if self.lumaOnly:
+            raise ValueError("Chroma is not decoded in luma-only mode")
+        if self.scaleShift:
+            return self.get_scaled_rows(
+                self.vScaled, self.uvScaledStride, 8, first_row, last_row
+            )
+        return self.get_plane_rows(self.vPlane, self.uvStride, 8, first_row, last_row)
+
+    def get_y_buffer(self, first_row=0, last_row=-1):
+        if self.scaleShift:
+            return self.get_scaled_rows(
+                self.yScaled, self.yScaledStride, 16, first_row, last_row
+            )
+        return self.get_plane_rows(self.yPlane, self.yStride, 16, first_row, last_row)
+
     def read_modes(self, bc):
-        mb_row = -1
-        prob_skip_false = 0
         if self.mb_no_coeff_skip > 0:
-            prob_skip_false = bc.read_literal(8)
-
-        while True:
-            mb_row += 1
-            if mb_row >= self.macroBlockRows:
-                return
-
-            mb_col = -1
-            while True:
-                mb_col += 1
-                if mb_col >= self.macroBlockCols:
-                    break
-
-                mb = self.get_macro_block(mb_col, mb_row)
-                if (
-                    self.segmentation_enabled > 0
-                    and self.update_mb_segmentation_map > 0
-                ):
-                    bc.treed_read(MB_SEGMENT_TREE, self.mb_segment_tree_probs)
-
-                if self.mb_no_coeff_skip > 0:
-                    var14 = bc.read_bool(prob_skip_false)
-                else:
-                    var14 = 0
-
-                mb.set_mb_skip_coeff(var14)
-                y_mode = self.read_y_mode(bc)
-                mb.set_y_mode(y_mode)
-
-                if y_mode == 4:
-                    for var15 in range(4):
-                        for x in range(4):
-                            var16 = mb.get_y_sub_block(x, var15)
-                            sb = self.get_above_sub_block(var16, SubBlock.PLANE.Y1)
-                            L = self.get_left_sub_block(var16, SubBlock.PLANE.Y1)
-                            mode1 = self.read_sub_block_mode(
-                                bc, sb.get_mode(), L.get_mode()
-                            )
-                            var16.set_mode(mode1)
-                else:
-                    mode = {0: 0, 1: 2, 2: 3, 3: 1}.get(y_mode, 0)
+            self.probSkipFalse = bc.read_literal(8)
+
+        # low-memory frames read the modes of a row right before its tokens
+        self.modeBoolDecoder = bc
+        if not self.lowMemory:
+            for mb_row in range(self.macroBlockRows):
+                self.read_mode_row(bc, mb_row)
+
+    @micropython.native
+    def read_mode_row(self, bc, mb_row):
+        prob_skip_false = self.probSkipFalse
+        left_modes = self.leftModes
+        for i in range(4):
+            left_modes[i] = 0
+
+        store = self.blocks
+        above_modes = self.aboveModes
+        b_modes = store.bModes
+        update_segments = (
+            self.segmentation_enabled > 0 and self.update_mb_segmentation_map > 0
+        )
+        for mb_col in range(self.macroBlockCols):
+            mb = store.index(mb_col, mb_row)
+            if update_segments:
+                store.segments[mb] = bc.treed_read(
+                    MB_SEGMENT_TREE, self.mb_segment_tree_probs
+                )
+            else:
+                store.segments[mb] = 0
+
+            if self.mb_no_coeff_skip > 0:
+                var14 = bc.read_bool(prob_skip_false)
+            else:
+                var14 = 0
 
+            store.skip[mb] = var14
+            y_mode = self.read_y_mode(bc)
+            store.yModes[mb] = y_mode
+
+            a = mb_col * 4
+            if y_mode == 4:
+                m = mb * 16
+                for var15 in range(4):
+                    mode1 = left_modes[var15]
                     for x in range(4):
-                        for y in range(4):
-                            sb = mb.get_y_sub_block(x, y)
-                            sb.set_mode(mode)
+                        mode1 = self.read_sub_block_mode(
+                            bc, above_modes[a + x], mode1
+                        )
+                        b_modes[m + var15 * 4 + x] = mode1
+                        above_modes[a + x] = mode1
+                    left_modes[var15] = mode1
+            else:
+                mode = _Y_TO_B_MODE[y_mode]
+
+                for x in range(4):
+                    above_modes[a + x] = mode
+                    left_modes[x] = mode
 
-                var15 = self.read_uv_mode(bc)
-                mb.set_uv_mode(var15)
+            store.uvModes[mb] = self.read_uv_mode(bc)
 
     def read_sub_block_mode(self, bc, A, L):
         return bc.treed_read(BMODE_TREE, KF_BMODE_PROB[A][L])
@@ -596,36 +890,99 @@ class VP8Frame:
         if num_part > 1:
             partition = partitions_start + 3 * (num_part - 1)
 
+        self.partitionOffsets = []
+        self.partitionEnds = []
         for i in range(num_part):
+            self.partitionOffsets.append(partition)
             if i < num_part - 1:
-                var10 = self.read_partition_size(data, partitions_start + i * 3)
+                partition += self.read_partition_size(data, partitions_start + i * 3)
+                self.partitionEnds.append(min(partition, self.frameSize))
             else:
-                var10 = len(data) - partition
+                self.partitionEnds.append(self.frameSize)
 
-            self.tokenBoolDecoders.append(BoolDecoder(self.frame, partition))
-            partition += var10
+        # partitions that are not buffered yet are set up by init_token_partition()
+        self.tokenBoolDecoders = [None] * num_part
+        for i in range(num_part):
+            if self.token_partition_ready(i, len(data)):
+                self.init_token_partition(i)
 
         self.tokenBoolDecoder = self.tokenBoolDecoders[0]
 
+    def token_partition_ready(self, i, available):
+        # the decoder loads its first bytes as soon as it is created
+        return (
+            min(self.partitionEnds[i], self.partitionOffsets[i] + WINDOW_BYTES)
+            <= available
+        )
+
+    def init_token_partition(self, i):
+        self.tokenBoolDecoders[i] = BoolDecoder(
+            self.frame, self.partitionOffsets[i], self.partitionEnds[i]
+        )
+
     def get_width(self):
         return self.width
 
     def get_height(self):
         return self.height
 
+    def get_scaled_width(self):
+        # size of the decoded picture, rounded up when scaled
+        return (self.width + (1 << self.scaleShift) - 1) >> self.scaleShift
+
+    def get_scaled_height(self):
+        return (self.height + (1 << self.scaleShift) - 1) >> self.scaleShift
+
+    def get_row_height(self):
+        # pixel rows per macroblock row in the planes
+        return 16 >> self.scaleShift
+
 
 class VP8Decoder:
-    def __init__(self):
-        self.coef_probs = None
+    def __init__(
+        self, loop_filter=True, low_memory=False, two_pass=False, parallel=None
+    ):
+        self.loop_filter = loop_filter
+        self.low_memory = low_memory
+        self.two_pass = two_pass
+        self.parallel = parallel
+        self.coef_probs = bytearray(COEF_PROBS_SIZE)
         self.frame_count = 0
         self.f = None
 
     def decode_frame(self, frame_data, debug=False):
-        self.coef_probs = [[[[l for l in k] for k in j] for j in i] for i in DEFAULT_COEF_PROBS]
-        self.f = VP8Frame(frame_data, self.coef_probs)
+        self.coef_probs[:] = DEFAULT_COEF_PROBS_FLAT
+        self.f = VP8Frame(
+            frame_data,
+            self.coef_probs,
+            self.loop_filter,
+            low_memory=self.low_memory,
+            two_pass=self.two_pass,
+            parallel=self.parallel,
+        )
         self.f.decode_frame(debug)
         self.frame_count += 1
 
+    def decode_frame_header(
+        self, frame_data, debug=False, frame_size=-1, scale=1, luma_only=False
+    ):
+        self.coef_probs[:] = DEFAULT_COEF_PROBS_FLAT
+        self.f = VP8Frame(
+            frame_data,
+            self.coef_probs,
+            self.loop_filter,
+            frame_size,
+            self.low_memory,
+            self.two_pass,
+            self.parallel,
+            scale,
+            luma_only,
+        )
+        if not self.f.decode_frame_header(debug):
+            raise ValueError("bad input: not intra")
+        self.frame_count += 1
+        return self.f
+
     def get_width(self):
         return self.f.get_width() if self.f else 0
 
@@ -1,25 +1,248 @@
 import micropython
 from .vp8decoder import VP8Decoder
 
+# BT.601 YUV -> RGB in 16.16 fixed point. Every channel is
+# clip[(y_tab[y] + chroma_tab[u or v]) >> 16]; y_tab carries the clip
+# table's offset so the sum never goes negative.
+YUV_FIX = 16
+YUV_CLIP_OFFSET = 320
+
+_yuv_tables = None
+
+
+def get_yuv_tables():
+    global _yuv_tables
+    if _yuv_tables is None:
+        y_tab = [
+            76284 * (i - 16) + (YUV_CLIP_OFFSET << YUV_FIX) for i in range(256)
+        ]
+        r_v_tab = [104595 * (i - 128) for i in range(256)]
+        g_u_tab = [-25625 * (i - 128) for i in range(256)]
+        g_v_tab = [-53281 * (i - 128) for i in range(256)]
+        b_u_tab = [132252 * (i - 128) for i in range(256)]
+        clip = bytearray(YUV_CLIP_OFFSET * 2 + 256)
+        for i in range(len(clip)):
+            clip[i] = max(0, min(255, i - YUV_CLIP_OFFSET))
+        _yuv_tables = (y_tab, r_v_tab, g_u_tab, g_v_tab, b_u_tab, clip)
+    return _yuv_tables
+
+
 @micropython.native
-def yuv_to_rgb(y_buffer, u_buffer, v_buffer, width, height):
-    # Create a blank image
-    dst = [[[] for _ in range(width)] for _ in range(height)]
-
-    for _x in range(width):
-        for _y in range(height):
-            y = y_buffer[_x][_y]
-            u = u_buffer[_x // 2][_y // 2]
-            v = v_buffer[_x // 2][_y // 2]
-            c = [
-                1.164 * (y - 16) + 1.596 * (v - 128),
-                1.164 * (y - 16) - 0.813 * (v - 128) - 0.391 * (u - 128),
-                1.164 * (y - 16) + 2.018 * (u - 128),
-            ]
-            dst[_y][_x] = [max(0, min(255, int(val))) for val in c]
-    
+def yuv_to_rgb(
+    y_buffer, u_buffer, v_buffer, width, height, y_stride, uv_stride, left=0
+):
+    # rows of the width columns starting at column left
+    y_tab, r_v_tab, g_u_tab, g_v_tab, b_u_tab, clip = get_yuv_tables()
+    dst = [[None] * width for _ in range(height)]
+    start = left & ~1
+    end = left + width
+
+    # one chroma sample feeds a 2x2 luma quad, of which an odd left column
+    # only keeps the right half
+    for _y in range(0, height, 2):
+        row0 = dst[_y]
+        row1 = dst[_y + 1] if _y + 1 < height else None
+        y0 = _y * y_stride
+        y1 = y0 + y_stride
+        c = (_y >> 1) * uv_stride + (start >> 1)
+
+        for _x in range(start, end, 2):
+            u = u_buffer[c]
+            v = v_buffer[c]
+            c += 1
+            r = r_v_tab[v]
+            g = g_u_tab[u] + g_v_tab[v]
+            b = b_u_tab[u]
+            o = _x - left
+
+            if o >= 0:
+                y = y_tab[y_buffer[y0 + _x]]
+                row0[o] = [
+                    clip[(y + r) >> 16],
+                    clip[(y + g) >> 16],
+                    clip[(y + b) >> 16],
+                ]
+                if row1 is not None:
+                    y = y_tab[y_buffer[y1 + _x]]
+                    row1[o] = [
+                        clip[(y + r) >> 16],
+                        clip[(y + g) >> 16],
+                        clip[(y + b) >> 16],
+                    ]
+
+            if _x + 1 < end:
+                y = y_tab[y_buffer[y0 + _x + 1]]
+                row0[o + 1] = [
+                    clip[(y + r) >> 16],
+                    clip[(y + g) >> 16],
+                    clip[(y + b) >> 16],
+                ]
+                if row1 is not None:
+                    y = y_tab[y_buffer[y1 + _x + 1]]
+                    row1[o + 1] = [
+                        clip[(y + r) >> 16],
+                        clip[(y + g) >> 16],
+                        clip[(y + b) >> 16],
+                    ]
+
     return dst
-    
+
+
+class PixelFormat:
+    RGB888 = "RGB888"
+    BGR888 = "BGR888"
+    RGBA8888 = "RGBA8888"
+    RGB565_BE = "RGB565_BE"
+    RGB565_LE = "RGB565_LE"
+    L8 = "L8"
+
+    BYTES_PER_PIXEL = {
+        RGB888: 3,
+        BGR888: 3,
+        RGBA8888: 4,
+        RGB565_BE: 2,
+        RGB565_LE: 2,
+        L8: 1,
+    }
+
+    @staticmethod
+    def bytes_per_pixel(fmt):
+        bpp = PixelFormat.BYTES_PER_PIXEL.get(fmt)
+        if bpp is None:
+            raise ValueError("Unsupported pixel format: " + str(fmt))
+        return bpp
+
+
+@micropython.native
+def yuv_to_packed(
+    y_buffer,
+    u_buffer,
+    v_buffer,
+    left,
+    top,
+    right,
+    bottom,
+    y_stride,
+    uv_stride,
+    fmt,
+    dst,
+    offset,
+    stride,
+):
+    # converts the [left, right) x [top, bottom) window of the planes,
+    # pixel (left, top) lands at dst[offset]
+    if fmt == PixelFormat.L8:
+        o = top * y_stride + left
+        width = right - left
+        for _y in range(top, bottom):
+            dst[offset : offset + width] = y_buffer[o : o + width]
+            o += y_stride
+            offset += stride
+        return
+
+    y_tab, r_v_tab, g_u_tab, g_v_tab, b_u_tab, clip = get_yuv_tables()
+    bpp = PixelFormat.bytes_per_pixel(fmt)
+    rgb565 = bpp == 2
+    # byte positions of R, G, B (or of the high and low RGB565 byte)
+    if fmt == PixelFormat.BGR888:
+        ri, gi, bi = 2, 1, 0
+    elif fmt == PixelFormat.RGB565_LE:
+        ri, gi, bi = 1, 0, 0
+    else:
+        ri, gi, bi = 0, 1, 2
+
+    # chroma terms are shared by both rows of a 2x2 luma quad
+    chroma_width = (right + 1) >> 1
+    r_row = [0] * chroma_width
+    g_row = [0] * chroma_width
+    b_row = [0] * chroma_width
+
+    for _y in range(top, bottom):
+        if _y == top or not _y & 1:
+            c = (_y >> 1) * uv_stride
+            for i in range(left >> 1, chroma_width):
+                u = u_buffer[c + i]
+                v = v_buffer[c + i]
+                r_row[i] = r_v_tab[v]
+                g_row[i] = g_u_tab[u] + g_v_tab[v]
+                b_row[i] = b_u_tab[u]
+
+        yo = _y * y_stride
+        o = offset
+        for _x in range(left, right):
+            y = y_tab[y_buffer[yo + _x]]
+            i = _x >> 1
+            r = clip[(y + r_row[i]) >> 16]
+            g = clip[(y + g_row[i]) >> 16]
+            b = clip[(y + b_row[i]) >> 16]
+            if rgb565:
+                dst[o + ri] = (r & 0xF8) | (g >> 5)
+                dst[o + 1 - ri] = ((g << 3) & 0xE0) | (b >> 3)
+            else:
+                dst[o + ri] = r
+                dst[o + gi] = g
+                dst[o + bi] = b
+                if bpp == 4:
+                    dst[o + 3] = 255
+            o += bpp
+        offset += stride
+
+
+def band_to_rgb(frame, first_row, last_row, left=0, right=-1):
+    # left/right select the columns converted
+    if right < 0:
+        right = frame.get_scaled_width()
+    size = frame.get_row_height()
+    height = min(last_row * size, frame.get_scaled_height()) - first_row * size
+    return yuv_to_rgb(
+        frame.get_y_buffer(first_row, last_row),
+        frame.get_u_buffer(first_row, last_row),
+        frame.get_v_buffer(first_row, last_row),
+        right - left,
+        height,
+        frame.get_y_stride(),
+        frame.get_uv_stride(),
+        left,
+    )
+
+
+def band_to_buffer(
+    frame,
+    first_row,
+    last_row,
+    fmt,
+    dst,
+    offset,
+    stride,
+    left=0,
+    top=0,
+    right=-1,
+    bottom=-1,
+):
+    # left/top/right/bottom select a window in band coordinates; L8 only
+    # reads the Y plane
+    if right < 0:
+        right = frame.get_scaled_width()
+    if bottom < 0:
+        size = frame.get_row_height()
+        bottom = min(last_row * size, frame.get_scaled_height()) - first_row * size
+    luma = fmt == PixelFormat.L8
+    yuv_to_packed(
+        frame.get_y_buffer(first_row, last_row),
+        None if luma else frame.get_u_buffer(first_row, last_row),
+        None if luma else frame.get_v_buffer(first_row, last_row),
+        left,
+        top,
+        right,
+        bottom,
+        frame.get_y_stride(),
+        frame.get_uv_stride(),
+        fmt,
+        dst,
+        offset,
+        stride,
+    )
+
 
 class WebPImage:
     def __init__(self, decoder):
@@ -62,104 +285,459 @@ class WebPImageType:
     WEBP = b"WEBP"
     VP8_ = b"VP8 "
     VP8X = b"VP8X"
+    VP8L = b"VP8L"
+    ALPH = b"ALPH"
+    ANIM = b"ANIM"
+    ANMF = b"ANMF"
 
 
-class WebPReader:
-    def __init__(self, input_stream):
-        self.image_read = WebPImage(VP8Decoder())
-        self.image_read.set_stream(input_stream)
+class WebPInfo:
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.h_scale = 0
+        self.v_scale = 0
+        self.has_alpha = False
+        self.has_animation = False
+        # (fourcc, payload offset, payload size) of every chunk header seen
+        self.chunks = []
+        self.frame_offset = -1
+        self.frame_size = 0
+        # leading bytes of the VP8 payload consumed while probing
+        self.frame_tag = b""
+
+    def __str__(self):
+        return "WebPInfo(%dx%d, scale=%d/%d, alpha=%s, animation=%s)" % (
+            self.width,
+            self.height,
+            self.h_scale,
+            self.v_scale,
+            self.has_alpha,
+            self.has_animation,
+        )
+
+
+def _read_exact(stream, size):
+    try:
+        data = stream.read(size)
+    except OSError:
+        raise OSError("Error reading stream")
+    if data is None or len(data) != size:
+        raise EOFError("Unexpected end of stream")
+    return data
+
+
+def _read_into(stream, view):
+    readinto = getattr(stream, "readinto", None)
+    while len(view):
+        try:
+            if readinto is not None:
+                n = readinto(view)
+            else:
+                data = stream.read(len(view))
+                n = len(data) if data else 0
+                view[:n] = data
+        except OSError:
+            raise OSError("Error reading stream")
+        if not n:
+            raise EOFError("Unexpected end of stream")
+        view = view[n:]
+
+
+def _skip(stream, size):
+    if size <= 0:
+        return
+    try:
+        stream.seek(size, 1)
+        return
+    except (AttributeError, OSError):
+        pass
+    while size > 0:
+        data = stream.read(min(size, 512))
+        if not data:
+            raise EOFError("Unexpected end of stream")
+        size -= len(data)
+
+
+def _parse_frame_tag(info, tag):
+    if tag[0] & 1:
+        raise ValueError("bad input: not intra")
+    if tag[3:6] != b"\x9d\x01\x2a":
+        raise ValueError("Bad VP8 start code!")
+    w = tag[6] | (tag[7] << 8)
+    h = tag[8] | (tag[9] << 8)
+    info.width = w & 16383
+    info.h_scale = w >> 14
+    info.height = h & 16383
+    info.v_scale = h >> 14
+
+
+class RIFFReader:
+    def __init__(self, source):
+        self.stream = None
+        self.buffer = None
+        self.pos = 0
+        self.end = 0
+        self.next_offset = 12
+        # (fourcc, payload offset, payload size) in file order
+        self.chunks = []
+        self.base = -1
+
+        try:
+            # bytes, bytearray, memoryview, mmap: payloads are sliced, not copied
+            self.buffer = memoryview(source)
+        except TypeError:
+            self.stream = source
+            try:
+                self.base = source.tell()
+            except (AttributeError, OSError):
+                pass
+
+    def read(self, size):
+        return bytes(self.read_view(size))
+
+    def read_view(self, size):
+        if self.buffer is not None:
+            if self.pos + size > len(self.buffer):
+                raise EOFError("Unexpected end of stream")
+            data = self.buffer[self.pos : self.pos + size]
+        else:
+            data = _read_exact(self.stream, size)
+        self.pos += size
+        return data
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        if self.buffer is not None:
+            view[:] = self.read_view(len(view))
+            return
+        _read_into(self.stream, view)
+        self.pos += len(view)
 
-    def _read_header(self):
-        if self.image_read.is_header_defined():
+    def seek(self, offset):
+        if offset == self.pos:
+            return
+        if self.buffer is not None:
+            if offset > len(self.buffer):
+                raise EOFError("Unexpected end of stream")
+            self.pos = offset
             return
+        if self.base >= 0:
+            try:
+                self.stream.seek(self.base + offset)
+                self.pos = offset
+                return
+            except OSError:
+                pass
+        if offset < self.pos:
+            raise OSError("Stream is not seekable")
+        _skip(self.stream, offset - self.pos)
+        self.pos = offset
+
+    def read_header(self):
+        if self.buffer is not None:
+            signature = bytes(self.buffer[:4])
+        else:
+            signature = self.stream.read(4)
+        if not signature:
+            raise ValueError("No input stream provided")
+        if signature != WebPImageType.RIFF:
+            raise ValueError("Bad RIFF signature!")
+        self.pos = 4
+
+        self.end = int.from_bytes(self.read(4), "little") + 8
+        if self.read(4) != WebPImageType.WEBP:
+            raise ValueError("Bad WEBP signature!")
+
+    def next_chunk(self):
+        if self.next_offset + 8 > self.end:
+            return None
+
+        self.seek(self.next_offset)
+        header = self.read(8)
+        size = int.from_bytes(header[4:], "little")
+        chunk = (bytes(header[:4]), self.pos, size)
+        self.chunks.append(chunk)
+        # payloads are padded to an even size
+        self.next_offset = self.pos + size + (size & 1)
+        return chunk
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+    def find(self, fourcc):
+        for chunk in self:
+            if chunk[0] == fourcc:
+                return chunk
+        return None
+
+
+def _head_size(fourcc):
+    # payload bytes _probe_chunk() reads of a chunk
+    if fourcc in (WebPImageType.VP8_, WebPImageType.VP8X):
+        return 10
+    if fourcc == WebPImageType.VP8L:
+        return 5
+    return 0
+
+
+def _probe_chunk(info, fourcc, offset, size, head):
+    # fills info from one chunk, given the first _head_size(fourcc) bytes of
+    # its payload; returns whether the chunks after it can be left unread
+    if fourcc == WebPImageType.VP8_:
+        info.frame_offset = offset
+        info.frame_size = size
+        info.frame_tag = bytes(head)
+        _parse_frame_tag(info, info.frame_tag)
+        return True
+    elif fourcc == WebPImageType.VP8L:
+        if head[0] != 0x2F:
+            raise ValueError("Bad VP8L signature!")
+        bits = int.from_bytes(head[1:], "little")
+        info.width = (bits & 16383) + 1
+        info.height = ((bits >> 14) & 16383) + 1
+        info.has_alpha = bool(bits & (1 << 28))
+        return True
+    elif fourcc == WebPImageType.VP8X:
+        info.has_alpha = bool(head[0] & 0x10)
+        info.has_animation = bool(head[0] & 0x02)
+        info.width = int.from_bytes(head[4:7], "little") + 1
+        info.height = int.from_bytes(head[7:10], "little") + 1
+    elif fourcc == WebPImageType.ALPH:
+        info.has_alpha = True
+    elif fourcc in (WebPImageType.ANIM, WebPImageType.ANMF):
+        info.has_animation = True
+        return True
+    return False
+
+
+def _probe(riff):
+    info = WebPInfo()
+    info.chunks = riff.chunks
+    riff.read_header()
+
+    for fourcc, offset, size in riff:
+        if _probe_chunk(info, fourcc, offset, size, riff.read(_head_size(fourcc))):
+            break
+
+    return info
+
+
+def probe(source):
+    return _probe(RIFFReader(source))
+
 
-        signature = self.image_read.get_stream().read(4)
+class WebPReader:
+    def __init__(
+        self,
+        source,
+        loop_filter=True,
+        low_memory=False,
+        two_pass=False,
+        parallel=None,
+    ):
+        # low_memory keeps only the few macroblock rows decoding still needs,
+        # rows are then available once, in order, through iter_rows(), read()
+        # and readinto(). two_pass parses the whole frame before the first
+        # row is reconstructed; parallel ("thread" or "process") also parses
+        # its token partitions and reconstructs its rows concurrently.
+        self.image_read = WebPImage(
+            VP8Decoder(loop_filter, low_memory, two_pass, parallel)
+        )
+        self.image_read.set_stream(source)
+        self.riff = RIFFReader(source)
+        self.info = None
+        self.mb_rows_decoded = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Releases the views of a bytes-like source, an mmap cannot be closed
+        # while they exist. No more rows can be read afterwards.
+        frame = self.image_read.get_decoder().get_frame()
+        for view in (frame.frame if frame else None, self.riff.buffer):
+            if isinstance(view, memoryview) and hasattr(view, "release"):
+                view.release()
+
+    def get_info(self):
+        if self.info is None:
+            self.info = _probe(self.riff)
+        return self.info
+
+    def get_chunk(self, fourcc):
+        self.get_info()
+        chunk = self.riff.find(fourcc)
+        if chunk is None:
+            return None
+        self.riff.seek(chunk[1])
+        return self.riff.read_view(chunk[2])
+
+    @staticmethod
+    def _clip_crop(frame, crop):
+        # the (x, y, w, h) window clipped to the (scaled) picture
+        if crop is None:
+            return None
+        x, y, w, h = crop
+        right = min(x + w, frame.get_scaled_width())
+        bottom = min(y + h, frame.get_scaled_height())
+        if x < 0 or y < 0 or x >= right or y >= bottom:
+            raise ValueError("Crop window outside the image: " + str(crop))
+        return (x, y, right - x, bottom - y)
+
+    def _read_header(self, scale=1, crop=None, luma_only=False):
+        # Rows are only decoded once, so later reads have to ask for the same
+        # scale and crop. A frame decoded for L8 has no chroma for others.
+        if self.image_read.is_header_defined():
+            frame = self.image_read.get_decoder().get_frame()
+            if (
+                frame.scale != scale
+                or frame.crop != self._clip_crop(frame, crop)
+                or (frame.lumaOnly and not luma_only)
+            ):
+                raise ValueError(
+                    "The image is already being read at another scale, crop or format"
+                )
+            return frame
+
+        info = self.get_info()
         self.image_read.set_header_defined(True)
 
-        if not signature:
-            raise ValueError("No input stream provided")
+        if info.frame_offset < 0:
+            raise ValueError("Bad VP8 signature!")
 
-        if signature == WebPImageType.RIFF:
-            try:
-                self.image_read.get_stream().read(4)  # Skip over 4 bytes
-                signature = self.image_read.get_stream().read(4)
-            except OSError as e:
-                raise OSError("Error reading WEBP signature")
-
-            if signature == WebPImageType.WEBP:
-                try:
-                    signature = self.image_read.get_stream().read(4)
-                except OSError as e:
-                    raise OSError("Error reading VP8 signature")
-
-                if signature == WebPImageType.VP8X:
-                    signature = bytearray(4)
-                    signature[:] = self.image_read.get_stream().read(4)
-
-                    while True:
-                        try:
-                            next_byte = self.image_read.get_stream().read(1)
-                            if not next_byte:
-                                break  # End of stream
-
-                            signature = signature[1:] + next_byte
-
-                            if signature == WebPImageType.VP8_:
-                                break
-                        except OSError as e:
-                            raise OSError(
-                                "Error reading stream while searching for VP8_"
-                            )
-
-                if signature == WebPImageType.VP8_:
-                    try:
-                        frame_size = int.from_bytes(
-                            self.image_read.get_stream().read(4), "little"
-                        )
-                    except OSError as e:
-                        raise OSError("Error reading frame size")
-
-                    print("VP8 image data size:", frame_size)
-
-                    frame = self.image_read.get_stream().read(frame_size)
-
-                    if len(frame) != frame_size:
-                        raise ValueError("Error reading frame: incorrect size")
-
-                    self.image_read.get_decoder().decode_frame(frame)
-                    self.image_read.set_width(self.image_read.get_decoder().get_width())
-                    self.image_read.set_height(
-                        self.image_read.get_decoder().get_height()
-                    )
-                else:
-                    raise ValueError("Bad VP8 signature!")
+        frame_size = info.frame_size
+
+        try:
+            if self.riff.buffer is not None:
+                self.riff.seek(info.frame_offset)
+                frame = self.riff.read_view(frame_size)
             else:
-                raise ValueError("Bad WEBP signature!")
-        else:
-            raise ValueError("Bad RIFF signature!")
+                # the tag was already read by probe(), the rest goes after it
+                tag = len(info.frame_tag)
+                frame = bytearray(frame_size)
+                frame[:tag] = info.frame_tag
+                self.riff.seek(info.frame_offset + tag)
+                self.riff.readinto(memoryview(frame)[tag:])
+        except EOFError:
+            raise ValueError("Error reading frame: incorrect size")
+
+        frame = self.image_read.get_decoder().decode_frame_header(
+            frame, scale=scale, luma_only=luma_only
+        )
+        if crop is not None:
+            frame.set_crop(*self._clip_crop(frame, crop))
+        self.image_read.set_width(frame.get_scaled_width())
+        self.image_read.set_height(frame.get_scaled_height())
+        return frame
 
     def get_width(self):
-        self._read_header()
-        return self.image_read.get_width()
+        return self.get_info().width
 
     def get_height(self):
-        self._read_header()
-        return self.image_read.get_height()
-    
-    def read(self):
-        self._read_header()  # get image width and height
-
-        # Get image width and height
-        width = self.image_read.get_width()
-        height = self.image_read.get_height()
-
-        frame = self.image_read.get_decoder().get_frame()
-        y_buffer = frame.get_y_buffer()
-        u_buffer = frame.get_u_buffer()
-        v_buffer = frame.get_v_buffer()
-        
-        img_rgb = yuv_to_rgb(y_buffer, u_buffer, v_buffer, width, height)
-        
-        del y_buffer, u_buffer, v_buffer
-
-        return img_rgb
+        return self.get_info().height
+
+    def _decode_row(self, frame, mb_row):
+        # prediction needs every row above, decode until mb_row is final
+        while frame.get_finished_rows(self.mb_rows_decoded) <= mb_row:
+            frame.decode_macro_block_row(self.mb_rows_decoded)
+            self.mb_rows_decoded += 1
+
+    def _window(self, scale, crop, luma_only=False):
+        frame = self._read_header(scale, crop, luma_only)
+        if frame.crop is None:
+            return frame, 0, 0, frame.get_scaled_width(), frame.get_scaled_height()
+        return (frame,) + frame.crop
+
+    def iter_rows(self, scale=1, crop=None):
+        frame, left, top, width, height = self._window(scale, crop)
+        size = frame.get_row_height()
+
+        for mb_row in range(top // size, (top + height - 1) // size + 1):
+            self._decode_row(frame, mb_row)
+            first = mb_row * size
+            rows = band_to_rgb(frame, mb_row, mb_row + 1, left, left + width)
+            for row in rows[max(top, first) - first : top + height - first]:
+                yield row
+
+    def read(self, format=None, scale=1, crop=None):
+        # scale 1/2, 1/4 or 1/8 returns the image averaged down by that
+        # factor, holding only a few full-size macroblock rows meanwhile.
+        # crop=(x, y, w, h) returns only that window of the (scaled) image;
+        # decoding stops below it and skips the macroblocks right of it that
+        # it does not depend on. L8 skips the chroma planes altogether.
+        if format is None:
+            return [row for row in self.iter_rows(scale, crop)]
+
+        frame, left, top, width, height = self._window(
+            scale, crop, format == PixelFormat.L8
+        )
+        stride = width * PixelFormat.bytes_per_pixel(format)
+        buf = bytearray(stride * height)
+        size = frame.get_row_height()
+
+        for mb_row in range(top // size, (top + height - 1) // size + 1):
+            self._decode_row(frame, mb_row)
+            first = mb_row * size
+            band_top = max(top, first)
+            band_to_buffer(
+                frame,
+                mb_row,
+                mb_row + 1,
+                format,
+                buf,
+                (band_top - top) * stride,
+                stride,
+                left,
+                band_top - first,
+                left + width,
+                min(top + height, first + size) - first,
+            )
+
+        return buf, width, height, stride
+
+    def readinto(self, buf, stride, x=0, y=0, format=PixelFormat.RGB888):
+        # Writes the image with its top-left corner at (x, y) of buf, a
+        # caller-owned buffer of rows stride bytes apart. Pixels falling
+        # outside buf are clipped; returns the number of rows written.
+        dst = memoryview(buf)
+        if getattr(dst, "itemsize", 1) != 1:
+            dst = dst.cast("B")
+        bpp = PixelFormat.bytes_per_pixel(format)
+
+        frame = self._read_header(luma_only=format == PixelFormat.L8)
+        left = max(0, -x)
+        top = max(0, -y)
+        right = min(frame.get_width(), stride // bpp - x)
+        bottom = min(frame.get_height(), len(dst) // stride - y)
+        if left >= right or top >= bottom:
+            return 0
+
+        for mb_row in range(top >> 4, ((bottom - 1) >> 4) + 1):
+            self._decode_row(frame, mb_row)
+            first = mb_row * 16
+            band_top = max(top, first)
+            band_to_buffer(
+                frame,
+                mb_row,
+                mb_row + 1,
+                format,
+                dst,
+                (y + band_top) * stride + (x + left) * bpp,
+                stride,
+                left,
+                band_top - first,
+                right,
+                min(bottom, first + 16) - first,
+            )
+
+        return bottom - top